@@ -1,16 +1,63 @@
+from collections import Counter
+
 from pybtex.style.formatting.unsrt import Style
 from formatting.apa import APAStyle
 from labels.apa import LabelStyle as APALabelStyle
 from pybtex.plugin import register_plugin
 from pybtex.style.template import names, sentence
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+# Labels computed and reused during this build
+stats = Counter()
 
 class MyAPALabelStyle(APALabelStyle):
+    # Shared by every instance, so that a label is computed once per build
+    # however many bibliographies and pages use the entry.  Keyed on the
+    # id of the entry, which is kept alive alongside its label so that the
+    # id cannot be reused.
+    labels = {}
+
     def format_label(self, entry):
-        return APALabelStyle.format_label(self, entry)
+        cached = self.labels.get(id(entry))
+        if cached is not None and cached[0] is entry:
+            stats['reused'] += 1
+            return cached[1]
+        stats['computed'] += 1
+        label = APALabelStyle.format_label(self, entry)
+        self.labels[id(entry)] = (entry, label)
+        return label
 
 class MyAPAStyle(Style):
     default_label_style = 'myapa'
 
+PLUGINS = [
+    ('pybtex.style.labels', 'myapa', MyAPALabelStyle),
+    ('pybtex.style.formatting', 'myapastyle', MyAPAStyle),
+]
+
+def register_plugins():
+    # pybtex keeps plugins in a per-process registry.  Registering on import
+    # as well as in setup() means any process that loads this module has
+    # them, including parallel build workers; force makes it repeatable.
+    for group, name, klass in PLUGINS:
+        register_plugin(group, name, klass, force=True)
+
+register_plugins()
+
+def builder_inited(app):
+    MyAPALabelStyle.labels.clear()
+    stats.clear()
+
+def build_finished(app, exception):
+    if stats:
+        logger.info('apastyle: computed %d labels, reused %d',
+                    stats['computed'], stats['reused'])
+
 def setup(app):
-    register_plugin('pybtex.style.labels', 'myapa', MyAPALabelStyle)
-    register_plugin('pybtex.style.formatting', 'myapastyle', MyAPAStyle)
\ No newline at end of file
+    register_plugins()
+    app.connect('builder-inited', builder_inited)
+    app.connect('build-finished', build_finished)
+    return {'version': '1.0',
+            'parallel_read_safe': True, 'parallel_write_safe': True}
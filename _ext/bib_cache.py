@@ -0,0 +1,153 @@
+import hashlib
+import inspect
+import os
+import pickle
+from functools import wraps
+from importlib.metadata import version
+
+import pybtex.plugin
+import sphinxcontrib.bibtex.bibfile as bibfile
+from sphinxcontrib.bibtex.domain import BibtexDomain
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+# On-disk cache of what sphinxcontrib-bibtex computes from references.bib:
+# the parsed database, keyed on the contents of the bib files, and the
+# formatted entries of each bibliography, keyed on those too plus the
+# styles' source, so editing apastyle.py invalidates them.  The cached
+# entries go stale only if pybtex or sphinxcontrib-bibtex change, and their
+# versions are part of every key.
+
+VERSIONS = (version('pybtex'), version('sphinxcontrib-bibtex'))
+
+cache_dir = None
+stats = {'hits': 0, 'misses': 0}
+_source_hashes = {}
+
+
+def key_for(*parts):
+    return hashlib.sha256(repr((VERSIONS,) + parts).encode()).hexdigest()
+
+
+def load(kind, key):
+    path = os.path.join(cache_dir, '%s-%s.pickle' % (kind, key))
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError):
+        stats['misses'] += 1
+        return None
+    stats['hits'] += 1
+    return value
+
+
+def store(kind, key, value):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, '%s-%s.pickle' % (kind, key))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def file_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def style_version(cls):
+    """Hash of the source of a style class and the classes it derives from,
+    which stands in for the version of a style defined in this repo."""
+    if cls not in _source_hashes:
+        h = hashlib.sha256()
+        for base in cls.__mro__:
+            try:
+                path = inspect.getsourcefile(base)
+            except TypeError:
+                continue
+            h.update(repr((base.__qualname__, file_hash(path))).encode())
+        _source_hashes[cls] = h.hexdigest()
+    return _source_hashes[cls]
+
+
+def formatting_style_version(name):
+    if not name:
+        return None
+    style = pybtex.plugin.find_plugin('pybtex.style.formatting', name)
+    label_style = pybtex.plugin.find_plugin('pybtex.style.labels',
+                                            style.default_label_style)
+    return name, style_version(style), style_version(label_style)
+
+
+def cached_parse_bibdata(parse_bibdata):
+    @wraps(parse_bibdata)
+    def wrapper(bibfilenames, encoding):
+        if cache_dir is None:
+            return parse_bibdata(bibfilenames, encoding)
+        key = key_for(encoding, [(f, file_hash(f)) for f in bibfilenames])
+        bibdata = load('bibdata', key)
+        if bibdata is None:
+            bibdata = parse_bibdata(bibfilenames, encoding)
+            store('bibdata', key, bibdata)
+        else:
+            # The files were only touched; record their mtimes now so
+            # sphinxcontrib-bibtex does not ask again
+            bibdata = bibdata._replace(bibfiles={
+                f: b._replace(mtime=bibfile.get_mtime(f))
+                for f, b in bibdata.bibfiles.items()})
+        return bibdata
+    return wrapper
+
+
+def cached_formatted_entries(get_formatted_entries):
+    @wraps(get_formatted_entries)
+    def wrapper(self, bibliography_key, docnames, tooltips, tooltips_style):
+        if cache_dir is None:
+            return get_formatted_entries(self, bibliography_key, docnames,
+                                         tooltips, tooltips_style)
+        bibliography = self.bibliographies[bibliography_key]
+        entries = dict(self.get_sorted_entries(bibliography_key, docnames))
+        key = key_for(
+            [(f, file_hash(f)) for f in sorted(self.bibdata.bibfiles)],
+            formatting_style_version(bibliography.style),
+            formatting_style_version(tooltips_style) if tooltips else None,
+            bibliography.labelprefix, list(entries))
+        formatted = load('entries', key)
+        if formatted is None:
+            results = list(get_formatted_entries(
+                self, bibliography_key, docnames, tooltips, tooltips_style))
+            store('entries', key, [(entry.key, f, t) for entry, f, t in results])
+            return iter(results)
+        return iter([(entries[k], f, t) for k, f, t in formatted])
+    return wrapper
+
+
+def config_inited(app, config):
+    global cache_dir
+    cache_dir = (config.bib_cache_dir
+                 or os.path.join(os.path.dirname(app.outdir), '.bib_cache'))
+
+
+def build_finished(app, exception):
+    logger.verbose('bibliography cache: %d hits, %d misses',
+                   stats['hits'], stats['misses'])
+
+
+def setup(app):
+    app.add_config_value('bib_cache_dir', '', '')
+    if not getattr(bibfile.parse_bibdata, 'bib_cache', False):
+        # process_bibdata looks parse_bibdata up in its module when it runs
+        bibfile.parse_bibdata = cached_parse_bibdata(bibfile.parse_bibdata)
+        BibtexDomain.get_formatted_entries = cached_formatted_entries(
+            BibtexDomain.get_formatted_entries)
+        bibfile.parse_bibdata.bib_cache = True
+    app.connect('config-inited', config_inited)
+    app.connect('build-finished', build_finished)
+    return {'version': '1.0',
+            'parallel_read_safe': True, 'parallel_write_safe': True}
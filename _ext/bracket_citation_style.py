@@ -1,10 +1,20 @@
+import copy
+from collections import Counter
 from dataclasses import dataclass, field
 import sphinxcontrib.bibtex.plugin
 
+from pybtex.richtext import BaseMultipartText
+from sphinx.util import logging
+from sphinxcontrib.bibtex.richtext import BaseReferenceText
 from sphinxcontrib.bibtex.style.referencing import BracketStyle
 from sphinxcontrib.bibtex.style.referencing.author_year \
     import AuthorYearReferenceStyle
 
+logger = logging.getLogger(__name__)
+
+# References formatted and reused during this build
+stats = Counter()
+
 
 def bracket_style() -> BracketStyle:
     return BracketStyle(
@@ -13,6 +23,40 @@ def bracket_style() -> BracketStyle:
     )
 
 
+def rebind(text, info):
+    """Copy of text in which every reference carries info."""
+    if not isinstance(text, BaseMultipartText):
+        return text
+    new = copy.copy(text)
+    new.parts = [rebind(part, info) for part in text.parts]
+    if isinstance(text, BaseReferenceText):
+        new.info = (info,)
+    return new
+
+
+class MemoisedTemplate:
+    """Stands in for the inner template of a role, and formats each entry
+    only once.  What the template produces for an entry is the same on every
+    page, except for the reference info (the page it links from and to),
+    which is swapped into the saved result for each citation."""
+
+    def __init__(self, template, role_name, memo):
+        self.template = template
+        self.role_name = role_name
+        self.memo = memo
+
+    def format_data(self, data):
+        key = (self.role_name, data['entry'].key,
+               data['formatted_entry'].label)
+        text = self.memo.get(key)
+        if text is None:
+            stats['formatted'] += 1
+            text = self.memo[key] = self.template.format_data(data)
+        else:
+            stats['reused'] += 1
+        return rebind(text, data['reference_info'])
+
+
 @dataclass
 class MyReferenceStyle(AuthorYearReferenceStyle):
     bracket_parenthetical: BracketStyle = field(default_factory=bracket_style)
@@ -21,8 +65,44 @@ class MyReferenceStyle(AuthorYearReferenceStyle):
     bracket_label: BracketStyle = field(default_factory=bracket_style)
     bracket_year: BracketStyle = field(default_factory=bracket_style)
 
+    def __post_init__(self):
+        super().__post_init__()
+        # sphinxcontrib-bibtex makes one instance per build, so these last
+        # for the build and are shared by all its documents
+        self.templates = {}
+        self.references = {}
 
-def setup(app):
+    def inner(self, role_name):
+        if role_name not in self.templates:
+            self.templates[role_name] = MemoisedTemplate(
+                super().inner(role_name), role_name, self.references)
+        return self.templates[role_name]
+
+
+def register_plugins():
+    # Registered on import as well as in setup(), so that any process that
+    # loads this module has the style, including parallel build workers
     sphinxcontrib.bibtex.plugin.register_plugin(
         'sphinxcontrib.bibtex.style.referencing',
-        'author_year_round', MyReferenceStyle)
\ No newline at end of file
+        'author_year_round', MyReferenceStyle, force=True)
+
+
+register_plugins()
+
+
+def builder_inited(app):
+    stats.clear()
+
+
+def build_finished(app, exception):
+    if stats:
+        logger.info('bracket_citation_style: formatted %d references, '
+                    'reused %d', stats['formatted'], stats['reused'])
+
+
+def setup(app):
+    register_plugins()
+    app.connect('builder-inited', builder_inited)
+    app.connect('build-finished', build_finished)
+    return {'version': '1.0',
+            'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import re
+
+from docutils import nodes
+from sphinx import addnodes
+from sphinx.util import docname_join, logging
+
+logger = logging.getLogger(__name__)
+
+
+# Sphinx rereads the pages whose source changed, but it rewrites the pages
+# that depend on them only for toctree numbering.  This extension records
+# what each page uses -- cross-reference targets, glue keys, citations and
+# the navigation built from _toc.yml -- and rewrites the pages whose inputs
+# changed, then reports every page written and why.
+
+BIB_ENTRY_RE = re.compile(r'^@\s*(\w+)\s*[{(]\s*([^,\s]+)\s*,', re.MULTILINE)
+GLUE_RE = re.compile(r'\bglue\(\s*[\'"]([^\'"]+)[\'"]')
+STD_REFTYPES = ('ref', 'numref', 'myst', 'any')
+
+
+def file_hash(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def bib_entries(app):
+    """Hash every entry of the bibliography files by its key."""
+    entries = {}
+    for name in app.config.bibtex_bibfiles or []:
+        path = os.path.join(app.srcdir, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        starts = list(BIB_ENTRY_RE.finditer(text))
+        for m, end in zip(starts, starts[1:] + [None]):
+            body = text[m.start():end.start() if end else len(text)]
+            entries[m.group(2)] = hashlib.sha256(body.strip().encode()).hexdigest()
+    return entries
+
+
+def toc_path(app):
+    path = getattr(app.config, 'external_toc_path', None)
+    if path and not os.path.isabs(path):
+        path = os.path.join(app.confdir, path)
+    return path
+
+
+def deps(env):
+    if not hasattr(env, 'build_deps'):
+        env.build_deps = {'refs': {}, 'pastes': {}, 'glue': {}, 'cites': {},
+                          'bibliographies': set(), 'bib': {}, 'toc': None,
+                          'nav': {}}
+    return env.build_deps
+
+
+def reason(app, docname, why):
+    app.build_deps_reasons.setdefault(docname, [])
+    if why not in app.build_deps_reasons[docname]:
+        app.build_deps_reasons[docname].append(why)
+
+
+def targets(env):
+    """Everything a reference can point at, with what a reference to it
+    shows: the page, anchor and title of each label, and the section,
+    figure or equation number it has been given."""
+    found = {}
+    std = env.domaindata.get('std', {})
+    for name, (docname, labelid, title) in std.get('labels', {}).items():
+        number = env.toc_secnumbers.get(docname, {}).get('#' + labelid)
+        for figtype in env.toc_fignumbers.get(docname, {}).values():
+            number = figtype.get(labelid, number)
+        found[('std', name)] = (docname, labelid, title, number)
+    for name, (docname, labelid) in std.get('anonlabels', {}).items():
+        found.setdefault(('std', name), (docname, labelid))
+    for name, value in env.domaindata.get('math', {}).get('objects', {}).items():
+        found[('math', name)] = tuple(value)
+    for docname, title in env.titles.items():
+        found[('doc', docname)] = (title.astext(),
+                                   env.toc_secnumbers.get(docname, {}).get(''))
+    return found
+
+
+def navigation(env):
+    """What the sidebar of every page shows: each page's title and number."""
+    return {docname: (title.astext(),
+                      env.toc_secnumbers.get(docname, {}).get(''))
+            for docname, title in env.titles.items()}
+
+
+def env_get_outdated(app, env, added, changed, removed):
+    app.build_deps_reasons = {}
+    for docname in added:
+        reason(app, docname, 'new page')
+    for docname in changed:
+        reason(app, docname, 'source changed')
+    d = deps(env)
+    outdated = set()
+
+    entries = bib_entries(app)
+    changed_keys = {key for key in set(entries) | set(d['bib'])
+                    if entries.get(key) != d['bib'].get(key)}
+    if d['bib'] and changed_keys:
+        for docname, keys in d['cites'].items():
+            for key in sorted(keys & changed_keys):
+                reason(app, docname, 'references.bib entry %s changed' % key)
+                outdated.add(docname)
+        for docname in d['bibliographies']:
+            reason(app, docname, 'references.bib changed')
+            outdated.add(docname)
+    d['bib'] = entries
+
+    # Pages whose toctree changed are reread by sphinx-external-toc; the
+    # others only need their sidebar rewritten, see env_get_updated
+    toc = file_hash(toc_path(app))
+    app.build_deps_toc_changed = bool(d['toc']) and toc != d['toc']
+    d['toc'] = toc
+
+    return sorted(outdated - set(added) - set(changed) - set(removed))
+
+
+def env_before_read_docs(app, env, docnames):
+    if not hasattr(app, 'build_deps_reasons'):
+        app.build_deps_reasons = {}
+    for docname in docnames:
+        if docname not in app.build_deps_reasons:
+            reason(app, docname, 'outdated (environment, config or another '
+                                 'extension)')
+    app.build_deps_read = set(docnames)
+    app.build_deps_targets = targets(env)
+    app.build_deps_cited = set().union(*deps(env)['cites'].values())
+
+
+def doctree_read(app, doctree):
+    env = app.env
+    docname = env.docname
+    d = deps(env)
+    refs = set()
+    cites = set()
+    for node in doctree.traverse(addnodes.pending_xref):
+        domain = node.get('refdomain')
+        reftype = node.get('reftype')
+        target = node.get('reftarget', '')
+        if domain == 'cite':
+            cites.update(key.strip() for key in target.split(','))
+        elif domain == 'math':
+            refs.add(('math', target))
+        elif reftype == 'doc':
+            refs.add(('doc', docname_join(docname, target)))
+        elif reftype in STD_REFTYPES:
+            refs.add(('std', target.lower()))
+    pastes = set()
+    for node in doctree.traverse(nodes.Element):
+        kind = type(node).__name__
+        if kind == 'bibliography':
+            d['bibliographies'].add(docname)
+        elif ('Paste' in kind or 'Glue' in kind) and node.get('key'):
+            pastes.add(node['key'])
+    d['refs'][docname] = refs
+    d['cites'][docname] = cites
+    d['pastes'][docname] = pastes
+    d['glue'][docname] = glued_keys(env.doc2path(docname))
+
+
+def glued_keys(path):
+    """The names a notebook glues, from the glue() calls in its code."""
+    if not str(path).endswith('.ipynb'):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        nb = json.load(f)
+    keys = set()
+    for cell in nb.get('cells', []):
+        if cell.get('cell_type') == 'code':
+            source = cell.get('source', '')
+            if isinstance(source, list):
+                source = ''.join(source)
+            keys.update(GLUE_RE.findall(source))
+    return keys
+
+
+def env_purge_doc(app, env, docname):
+    d = deps(env)
+    for what in ('refs', 'pastes', 'glue', 'cites'):
+        d[what].pop(docname, None)
+    d['bibliographies'].discard(docname)
+
+
+def env_merge_info(app, env, docnames, other):
+    d, o = deps(env), deps(other)
+    for what in ('refs', 'pastes', 'glue', 'cites'):
+        for docname in docnames:
+            if docname in o[what]:
+                d[what][docname] = o[what][docname]
+    d['bibliographies'].update(o['bibliographies'] & set(docnames))
+
+
+def env_get_updated(app, env):
+    """Pages that were not reread but show something that changed.  Runs
+    after Sphinx has renumbered sections and figures."""
+    d = deps(env)
+    read = getattr(app, 'build_deps_read', set())
+    before = getattr(app, 'build_deps_targets', {})
+    after = targets(env)
+    changed = {t for t in set(before) | set(after)
+               if before.get(t) != after.get(t)}
+    rewrite = set()
+    for docname, refs in d['refs'].items():
+        if docname in read:
+            continue
+        for target in sorted(refs & changed):
+            reason(app, docname, 'refers to %s, which changed' % target[1])
+            rewrite.add(docname)
+
+    glued = {}
+    for docname in read:
+        for key in d['glue'].get(docname, ()):
+            glued[key] = docname
+    for docname, keys in d['pastes'].items():
+        for key in sorted(keys):
+            source = glued.get(key)
+            if source and docname not in read and source != docname:
+                reason(app, docname, 'pastes glue %s from %s, which was '
+                                     'reread' % (key, source))
+                rewrite.add(docname)
+
+    cited = set().union(*d['cites'].values())
+    if cited != getattr(app, 'build_deps_cited', cited):
+        for docname in d['bibliographies'] - read:
+            reason(app, docname, 'the set of cited references changed')
+            rewrite.add(docname)
+
+    # The sidebar of every page lists every page, so it is stale everywhere
+    # when the toc, a title or a chapter number changes
+    nav = navigation(env)
+    why = None
+    if getattr(app, 'build_deps_toc_changed', False):
+        why = '_toc.yml changed'
+    elif d['nav'] and nav != d['nav']:
+        why = 'navigation changed (%s)' % ', '.join(sorted(
+            n for n in set(nav) | set(d['nav'])
+            if nav.get(n) != d['nav'].get(n)))
+    if why:
+        for docname in env.found_docs - read:
+            reason(app, docname, why)
+        rewrite.update(env.found_docs)
+    d['nav'] = nav
+    return sorted(rewrite - read)
+
+
+def doctree_resolved(app, doctree, docname):
+    # Emitted in the main process for every page about to be written, also
+    # when the writing itself is done in parallel
+    app.build_deps_written.add(docname)
+
+
+def builder_inited(app):
+    app.build_deps_written = set()
+
+
+def build_finished(app, exception):
+    if exception or app.builder.format != 'html':
+        return
+    written = sorted(app.build_deps_written)
+    reasons = getattr(app, 'build_deps_reasons', {})
+    for docname in written:
+        # Sphinx adds the pages whose toctree includes a rewritten page
+        reasons.setdefault(docname, ['a page in its toctree changed'])
+    logger.info('Rewrote %d of %d pages.', len(written),
+                len(app.env.all_docs))
+    for docname in written:
+        logger.info('  %s: %s', docname, '; '.join(reasons[docname]))
+    if app.config.build_deps_report:
+        with open(app.config.build_deps_report, 'w') as f:
+            json.dump({docname: reasons[docname] for docname in written}, f,
+                      indent=1, sort_keys=True)
+
+
+def setup(app):
+    app.add_config_value('build_deps_report', '', '')
+    app.connect('builder-inited', builder_inited)
+    app.connect('env-get-outdated', env_get_outdated)
+    app.connect('env-before-read-docs', env_before_read_docs)
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', env_purge_doc)
+    app.connect('env-merge-info', env_merge_info)
+    # After the toctree collector has assigned section and figure numbers
+    app.connect('env-get-updated', env_get_updated, priority=900)
+    app.connect('doctree-resolved', doctree_resolved)
+    app.connect('build-finished', build_finished)
+    return {'version': '1', 'env_version': 1,
+            'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,214 @@
+import glob
+import importlib
+import json
+import os
+import time
+from functools import wraps
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Spans are Chrome trace 'complete' events on the wall clock, in
+# microseconds, so that they line up with the notebook execution events
+# from run_notebooks.py --events when trace_build.py merges the two.
+
+# Chrome trace thread ids for each kind of span
+THREADS = {'phases': 0, 'read': 1, 'bibliography': 2, 'write': 3, 'finish': 4}
+
+
+def now_us():
+    return time.time() * 1e6
+
+
+class Spans(list):
+    """The spans of one build.  Spans recorded in a forked worker, as the
+    write_doc calls of a parallel (-j) build are, would be lost with the
+    worker; they go to a file next to the trace instead, which collect reads
+    back in the main process."""
+
+    def __init__(self, trace_file):
+        super().__init__()
+        self.pid = os.getpid()
+        self.pattern = glob.escape(trace_file) + '.*.part'
+        self.part = trace_file + '.%d.part'
+        for path in glob.glob(self.pattern):
+            os.remove(path)  # Left over from an interrupted build
+
+    def append(self, span):
+        if os.getpid() == self.pid:
+            super().append(span)
+        else:
+            with open(self.part % os.getpid(), 'a') as f:
+                f.write(json.dumps(span) + '\n')
+
+    def collect(self):
+        for path in glob.glob(self.pattern):
+            with open(path) as f:
+                self.extend(json.loads(line) for line in f)
+            os.remove(path)
+
+
+def span(name, cat, start, tid, **args):
+    return {'name': name, 'cat': cat, 'ph': 'X', 'ts': start,
+            'dur': now_us() - start, 'pid': os.getpid(), 'tid': THREADS[tid],
+            'args': args}
+
+
+def timed(spans, name, cat, tid, func, name_arg=None):
+    """Wrap func so every call adds a span to spans.  With name_arg, the
+    call's positional argument of that index is appended to the name."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = now_us()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            label = name
+            if name_arg is not None and len(args) > name_arg:
+                label = '%s %s' % (name, args[name_arg])
+            spans.append(span(label, cat, start, tid))
+    return wrapper
+
+
+def wrap_attribute(spans, owner, attr, name, cat, tid, name_arg=None):
+    func = getattr(owner, attr, None)
+    if func is None:
+        logger.warning('build_trace: %s has no %s; no %r spans',
+                       getattr(owner, '__name__', owner), attr, name)
+        return
+    setattr(owner, attr, timed(spans, name, cat, tid, func, name_arg))
+
+
+# The bibliography is parsed and formatted inside sphinxcontrib-bibtex 2.x,
+# which has no events of its own; these are the functions that do the work.
+# process_bibdata looks parse_bibdata up in its module each time, and the
+# domain's env_updated formats every bibliography through
+# get_formatted_entries.
+BIBTEX_HOOKS = [
+    ('sphinxcontrib.bibtex.bibfile', None, 'parse_bibdata',
+     'parse references.bib'),
+    ('sphinxcontrib.bibtex.domain', 'BibtexDomain', 'env_updated',
+     'format citations'),
+    ('sphinxcontrib.bibtex.domain', 'BibtexDomain', 'get_formatted_entries',
+     'format bibliography'),
+]
+
+
+def enabled(app):
+    # The extension is always loaded, so that a traced build reads the same
+    # documents as any other; it only records when trace_build.py asks
+    return bool(app.config.build_trace_file)
+
+
+def config_inited(app, config):
+    if not enabled(app):
+        return
+    app.build_trace = Spans(config.build_trace_file)
+    app.build_trace_start = now_us()
+    # Before builder-inited, where sphinxcontrib-bibtex parses the bib files
+    for module, cls, attr, name in BIBTEX_HOOKS:
+        try:
+            owner = importlib.import_module(module)
+            if cls:
+                owner = getattr(owner, cls)
+        except (ImportError, AttributeError):
+            logger.warning('build_trace: cannot find %s.%s; no %r spans',
+                           module, cls or attr, name)
+            continue
+        wrap_attribute(app.build_trace, owner, attr, name, 'bibliography',
+                       'bibliography')
+
+
+def builder_inited(app):
+    if not enabled(app):
+        return
+    builder = app.builder
+    wrap_attribute(app.build_trace, builder, 'write_doc', 'write', 'write',
+                   'write', name_arg=0)
+    wrap_attribute(app.build_trace, builder, 'copy_image_files',
+                   'copy images', 'copy', 'finish')
+    wrap_attribute(app.build_trace, builder, 'copy_static_files',
+                   'copy static files', 'copy', 'finish')
+    wrap_attribute(app.build_trace, builder, 'dump_search_index',
+                   'write search index', 'write', 'finish')
+
+
+def env_before_read_docs(app, env, docnames):
+    if not enabled(app):
+        return
+    app.build_trace_read_start = now_us()
+    # Only the documents read by this build belong in its trace
+    env.build_trace_reads = {}
+    env.build_trace_open = {}
+
+
+def source_read(app, docname, source):
+    if not enabled(app):
+        return
+    app.env.build_trace_open[docname] = now_us()
+
+
+def doctree_read(app, doctree):
+    if not enabled(app):
+        return
+    env = app.env
+    start = env.build_trace_open.pop(env.docname, None)
+    if start is not None:
+        # Reading a notebook includes executing it, when Sphinx does that
+        env.build_trace_reads[env.docname] = span(
+            'read ' + env.docname, 'read', start, 'read')
+
+
+def env_purge_doc(app, env, docname):
+    getattr(env, 'build_trace_reads', {}).pop(docname, None)
+
+
+def env_merge_info(app, env, docnames, other):
+    # Spans recorded by parallel read workers come back with their env
+    if enabled(app):
+        env.build_trace_reads.update(getattr(other, 'build_trace_reads', {}))
+
+
+def env_updated(app, env):
+    start = getattr(app, 'build_trace_read_start', None)
+    if start is not None:
+        app.build_trace.append(span('read sources', 'phase', start, 'phases'))
+    app.build_trace_write_start = now_us()
+
+
+def build_finished(app, exception):
+    if not enabled(app):
+        return
+    app.build_trace.collect()
+    trace = list(app.build_trace)
+    trace.extend(getattr(app.env, 'build_trace_reads', {}).values())
+    start = getattr(app, 'build_trace_write_start', None)
+    if start is not None:
+        trace.append(span('write output', 'phase', start, 'phases'))
+    trace.append(span('sphinx build', 'phase', app.build_trace_start,
+                      'phases'))
+    for pid in set(e['pid'] for e in trace):
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                      'args': {'name': 'sphinx %d' % pid}})
+        for name, tid in THREADS.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                          'tid': tid, 'args': {'name': name}})
+    with open(app.config.build_trace_file, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def setup(app):
+    # Not 'env': setting it must not make Sphinx read every document again
+    app.add_config_value('build_trace_file', '', '')
+    app.connect('config-inited', config_inited)
+    app.connect('builder-inited', builder_inited)
+    app.connect('env-before-read-docs', env_before_read_docs)
+    app.connect('source-read', source_read)
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', env_purge_doc)
+    app.connect('env-merge-info', env_merge_info)
+    app.connect('env-updated', env_updated)
+    app.connect('build-finished', build_finished)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+import shutil
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Every image the build outputs is kept once, in a content-addressed store
+# under _build/.image_store, and both jupyter_execute and html/_images hold
+# hard links to it instead of copies of their own.  The link count of a
+# store file is its reference count: a file with no other links is no
+# longer used by either tree and is removed at the end of the build.
+#
+# Hard links share their bytes, so nothing may write through one.  Links
+# are only ever replaced, never opened for writing, and the images of a
+# notebook are unlinked before it is read again, since myst-nb rewrites
+# them in place.
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def replace_with_link(target, path):
+    """Make path a hard link to target, falling back to a copy on a
+    filesystem without hard links."""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.link(target, tmp)
+    except OSError:
+        shutil.copyfile(target, tmp)
+    os.replace(tmp, path)
+
+
+class ImageStore:
+
+    def __init__(self, root, owned):
+        self.root = root
+        self.owned = owned  # Files under this directory may be linked in
+        self.added = 0
+        self.shared = 0
+
+    def path_for(self, h, ext):
+        return os.path.join(self.root, h[:2], h + ext)
+
+    def add(self, path):
+        """Return the store file with the contents of path, adding them if
+        they are new.  Files the build made are linked in; others, like the
+        images in Chapters/, are copied, since they may be edited in place."""
+        stored = self.path_for(file_hash(path), os.path.splitext(path)[1])
+        if not os.path.exists(stored):
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            if os.path.abspath(path).startswith(self.owned + os.sep):
+                replace_with_link(path, stored)
+            else:
+                tmp = '%s.%d.tmp' % (stored, os.getpid())
+                shutil.copyfile(path, tmp)
+                os.replace(tmp, stored)
+            self.added += 1
+        elif (os.path.abspath(path).startswith(self.owned + os.sep)
+              and not os.path.samefile(path, stored)):
+            replace_with_link(stored, path)
+        return stored
+
+    def link(self, stored, path):
+        if os.path.exists(path) and os.path.samefile(stored, path):
+            return
+        replace_with_link(stored, path)
+        self.shared += 1
+
+    def collect_garbage(self):
+        """Remove the store files nothing links to; returns their number."""
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+
+def output_dirs(app):
+    build = os.path.dirname(os.path.abspath(app.outdir))
+    return (app.config.image_store_dir or os.path.join(build, '.image_store'),
+            os.path.join(build, 'jupyter_execute'))
+
+
+def builder_inited(app):
+    root, jupyter_execute = output_dirs(app)
+    app.image_store = ImageStore(root, jupyter_execute)
+    builder = app.builder
+    if getattr(builder, 'copy_image_files', None) is None:
+        return
+
+    def copy_image_files():
+        images = os.path.join(builder.outdir, getattr(builder, 'imagedir', ''))
+        os.makedirs(images, exist_ok=True)
+        for src, dest in builder.images.items():
+            stored = app.image_store.add(os.path.join(builder.srcdir, src))
+            app.image_store.link(stored, os.path.join(images, dest))
+    builder.copy_image_files = copy_image_files
+
+
+def env_before_read_docs(app, env, docnames):
+    # myst-nb writes a notebook's images as <docname>_<cell>_<output>.<ext>
+    # by opening the existing files, which must not be links to the store
+    _, jupyter_execute = output_dirs(app)
+    if not os.path.isdir(jupyter_execute):
+        return
+    patterns = [re.compile(re.escape(os.path.basename(docname)) + r'_\d+_\d+\.')
+                for docname in docnames]
+    for dirpath, dirnames, filenames in os.walk(jupyter_execute):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if (any(p.match(name) for p in patterns)
+                    and os.stat(path).st_nlink > 1):
+                os.remove(path)
+
+
+def build_finished(app, exception):
+    store = getattr(app, 'image_store', None)
+    if exception or store is None or not os.path.isdir(store.root):
+        return
+    removed = store.collect_garbage()
+    logger.info('image store: %d images added, %d links made, %d unused '
+                'removed', store.added, store.shared, removed)
+
+
+def setup(app):
+    app.add_config_value('image_store_dir', '', '')
+    app.connect('builder-inited', builder_inited)
+    app.connect('env-before-read-docs', env_before_read_docs)
+    app.connect('build-finished', build_finished)
+    return {'version': '1.0',
+            'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -1,12 +1,36 @@
 #!/bin/bash
 
+# build.sh --trace [trace_build.py options]: build without publishing, and
+# write a Chrome/Perfetto trace of the build to build_trace.json
+if [ "$1" == "--trace" ]; then
+    shift
+    python /Users/ethan/Documents/GitHub/pythonbook/trace_build.py /Users/ethan/Documents/GitHub/pythonbook/Chapters/ --path-output /Users/ethan/Documents/GitHub/pythonbook/Book --config /Users/ethan/Documents/GitHub/pythonbook/yaml/_config.yml --toc /Users/ethan/Documents/GitHub/pythonbook/yaml/_toc.yml "$@"
+    exit $?
+fi
+
+# execute new and changed notebooks into the cache the book build reads
+(cd /Users/ethan/Documents/GitHub/pythonbook/Chapters/ && python /Users/ethan/Documents/GitHub/pythonbook/run_notebooks.py --book-cache /Users/ethan/Documents/GitHub/pythonbook/Book/_build/.jupyter_cache)
+
 # build html documents
 jupyter-book build /Users/ethan/Documents/GitHub/pythonbook/Chapters/ --path-output /Users/ethan/Documents/GitHub/pythonbook/Book --config /Users/ethan/Documents/GitHub/pythonbook/yaml/_config.yml --toc /Users/ethan/Documents/GitHub/pythonbook/yaml/_toc.yml
 
+# recompress the figures, and offer WebP versions of them
+python /Users/ethan/Documents/GitHub/pythonbook/optimise_images.py --webp --rewrite-html
+
+# split the search index into shards the search page loads as needed
+python /Users/ethan/Documents/GitHub/pythonbook/shard_search.py
+
+# bundle and fingerprint the stylesheets and scripts, and drop unused ones
+python /Users/ethan/Documents/GitHub/pythonbook/bundle_assets.py
+
+# write gzip and brotli versions of the final files, once nothing else
+# changes them
+python /Users/ethan/Documents/GitHub/pythonbook/compress_site.py
+
 # push to GitHub
 
 ghp-import -n -p -f Book/_build/html
 
 git add -A
 git commit -m "auto-updated with build.sh"
-git push origin main
\ No newline at end of file
+git push origin main
@@ -0,0 +1,386 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import glob
+import hashlib
+import re
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HTML_DIR = os.path.join(HERE, 'Book', '_build', 'html')
+BUNDLE_DIR = os.path.join('_static', 'bundles')
+# Suffixes of the variants compress_site.py writes next to each file
+PRECOMPRESSED = ('.gz', '.br')
+
+TAG_RE = re.compile(r'<link\b[^>]*>|<script\b[^>]*>\s*</script>', re.I)
+ATTR_RE = re.compile(r'([\w:.-]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>"\']+)))?')
+URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+IMPORT_RE = re.compile(r'@import\s+([\'"])([^\'"]+)\1')
+# Paths written out in a page, e.g. in inline styles and scripts
+STATIC_PATH_RE = re.compile(r'(?:\.\./)*_static/[\w./-]+')
+# File names a script mentions; scripts build some paths at run time, so any
+# file with a mentioned name is kept
+FILE_NAME_RE = re.compile(r'[\w.-]+\.(?:js|css|json|map|png|svg|gif|jpe?g|ico|'
+                          r'woff2?|ttf|eot|otf|html|txt)\b')
+SOURCE_MAP_RE = re.compile(r'^\s*(?://|/\*)# sourceMappingURL=.*$', re.M)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+CSS_STRING_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'')
+
+
+def attributes(tag):
+    body = re.sub(r'^<\w+|/?>(\s*</script>)?$', '', tag.strip())
+    attrs = {}
+    for m in ATTR_RE.finditer(body):
+        value = next((v for v in m.groups()[1:] if v is not None), '')
+        attrs[m.group(1).lower()] = value
+    return attrs
+
+
+def is_local(url):
+    return not re.match(r'^([a-z][\w+.-]*:|//|#)', url, re.I)
+
+
+def resolve(page_dir, url, root):
+    """The file a relative URL in a page or stylesheet points at, relative
+    to root, or None if it points elsewhere."""
+    path = url.split('#', 1)[0].split('?', 1)[0]
+    if not path or not is_local(path) or path.startswith('/'):
+        return None
+    full = os.path.normpath(os.path.join(page_dir, path))
+    if not full.startswith(root + os.sep):
+        return None
+    return os.path.relpath(full, root)
+
+
+def bundleable(tag, attrs):
+    """'css' or 'js' for a tag that can be merged with its neighbours: a
+    plain stylesheet link, or a classic script with nothing but a src."""
+    if tag.lower().startswith('<link'):
+        if ('stylesheet' in attrs.get('rel', '').split()
+                and set(attrs) <= {'rel', 'href', 'type'}
+                and is_local(attrs.get('href', ''))):
+            return 'css'
+    elif (set(attrs) <= {'src', 'type'}
+          and attrs.get('type', 'text/javascript') == 'text/javascript'
+          and is_local(attrs.get('src', ''))):
+        return 'js'
+    return None
+
+
+def minify_css(text):
+    """Strip comments and collapse whitespace, leaving strings alone."""
+    if rcssmin is not None:
+        return rcssmin.cssmin(text)
+    out = []
+    pos = 0
+    for m in CSS_STRING_RE.finditer(text):
+        out.append(_squeeze_css(text[pos:m.start()]))
+        out.append(m.group(0))
+        pos = m.end()
+    out.append(_squeeze_css(text[pos:]))
+    return ''.join(out).strip()
+
+
+def _squeeze_css(text):
+    text = CSS_COMMENT_RE.sub('', text)
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'\s*([{};,])\s*', r'\1', text)
+
+
+def minify_js(text):
+    # Without rjsmin, scripts are only concatenated: anything short of a
+    # real parser can break them
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    return text
+
+
+class Bundler:
+    """Makes one fingerprinted file for each distinct sequence of assets."""
+
+    def __init__(self, root):
+        self.root = root
+        self.bundles = {}  # (kind, asset paths) -> bundle path under root
+
+    def bundle(self, kind, assets):
+        key = (kind, tuple(assets))
+        if key in self.bundles:
+            return self.bundles[key]
+        out_dir = os.path.join(self.root, BUNDLE_DIR)
+        parts = []
+        for asset in assets:
+            with open(os.path.join(self.root, asset), encoding='utf-8') as f:
+                text = SOURCE_MAP_RE.sub('', f.read())
+            if kind == 'css':
+                text = self.rebase_urls(text, os.path.dirname(asset), out_dir)
+                text = re.sub(r'@charset\s+[^;]+;', '', text)
+                parts.append(minify_css(text))
+            else:
+                parts.append(minify_js(text).rstrip() + '\n;')
+        data = '\n'.join(parts).encode('utf-8')
+        if len(assets) == 1:
+            stem = os.path.splitext(os.path.basename(assets[0]))[0]
+        else:
+            stem = 'bundle'
+        name = '%s.%s.%s' % (stem, hashlib.sha256(data).hexdigest()[:16], kind)
+        path = os.path.join(BUNDLE_DIR, name)
+        full = os.path.join(self.root, path)
+        if not os.path.exists(full):
+            os.makedirs(out_dir, exist_ok=True)
+            tmp = '%s.%d.tmp' % (full, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, full)
+        self.bundles[key] = path
+        return path
+
+    def rebase_urls(self, text, asset_dir, out_dir):
+        """Point the url()s of a stylesheet moved to out_dir at the files its
+        original location referred to."""
+        def rebase(m):
+            url = m.group(2)
+            if not is_local(url) or url.startswith(('/', 'data:')):
+                return m.group(0)
+            target = os.path.normpath(os.path.join(self.root, asset_dir, url))
+            rel = os.path.relpath(target, out_dir).replace(os.sep, '/')
+            return 'url(%s%s%s)' % (m.group(1), rel, m.group(1))
+        return URL_RE.sub(rebase, text)
+
+
+def tag_for(kind, url):
+    if kind == 'css':
+        return '<link rel="stylesheet" type="text/css" href="%s" />' % url
+    return '<script src="%s"></script>' % url
+
+
+def has_import(root, asset):
+    try:
+        with open(os.path.join(root, asset), encoding='utf-8') as f:
+            return '@import' in f.read()
+    except (OSError, UnicodeDecodeError):
+        return True
+
+
+def bundle_page(html, page_dir, root, bundler):
+    """Replace every run of adjacent stylesheet links, and of adjacent
+    plain scripts, with one tag for their bundle.  Preloads of the bundled
+    files are pointed at the bundle.  Returns the new html and the number
+    of asset requests it saves."""
+    runs = []
+    run = []
+    prev_end = None
+    for m in TAG_RE.finditer(html):
+        attrs = attributes(m.group(0))
+        kind = bundleable(m.group(0), attrs)
+        asset = None
+        if kind:
+            asset = resolve(page_dir, attrs.get('href') or attrs.get('src'), root)
+            if (asset is None or not os.path.isfile(os.path.join(root, asset))
+                    or asset.startswith(BUNDLE_DIR + os.sep)
+                    or (kind == 'css' and has_import(root, asset))):
+                kind = None
+        contiguous = (run and run[-1][1] == kind and prev_end is not None
+                      and not html[prev_end:m.start()].strip())
+        if run and not contiguous:
+            runs.append(run)
+            run = []
+        if kind:
+            run.append((m, kind, asset))
+        prev_end = m.end()
+    if run:
+        runs.append(run)
+
+    bundled = {}
+    saved = 0
+    pieces = []
+    pos = 0
+    for run in runs:
+        kind = run[0][1]
+        assets = [asset for _, _, asset in run]
+        path = bundler.bundle(kind, assets)
+        url = os.path.relpath(os.path.join(root, path), page_dir).replace(os.sep, '/')
+        for asset in assets:
+            bundled[asset] = url
+        pieces.append(html[pos:run[0][0].start()])
+        pieces.append(tag_for(kind, url))
+        pos = run[-1][0].end()
+        saved += len(run) - 1
+    pieces.append(html[pos:])
+    html = ''.join(pieces)
+
+    preloaded = set()
+    def preload(m):
+        attrs = attributes(m.group(0))
+        if attrs.get('rel') != 'preload':
+            return m.group(0)
+        asset = resolve(page_dir, attrs.get('href', ''), root)
+        if asset not in bundled:
+            return m.group(0)
+        url = bundled[asset]
+        if url in preloaded:
+            return ''
+        preloaded.add(url)
+        return re.sub(r'href="[^"]*"', 'href="%s"' % url, m.group(0))
+    html = re.sub(r'<link\b[^>]*>', preload, html)
+    return html, saved
+
+
+def live_assets(root, pages):
+    """Every file under _static that a page, a stylesheet it loads or a
+    script it runs refers to, directly or through others."""
+    static = os.path.join(root, '_static')
+    by_name = {}
+    for path in glob.glob(os.path.join(static, '**', '*'), recursive=True):
+        if os.path.isfile(path):
+            by_name.setdefault(os.path.basename(path), []).append(
+                os.path.relpath(path, root))
+
+    live = set()
+    todo = []
+
+    def mark(asset):
+        if asset and asset not in live and os.path.isfile(os.path.join(root, asset)):
+            live.add(asset)
+            todo.append(asset)
+
+    for page in pages:
+        page_dir = os.path.dirname(page)
+        with open(page, encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        for m in TAG_RE.finditer(html):
+            attrs = attributes(m.group(0))
+            mark(resolve(page_dir, attrs.get('href') or attrs.get('src') or '',
+                         root))
+        for m in STATIC_PATH_RE.finditer(html):
+            mark(resolve(page_dir, m.group(0), root))
+        for m in re.finditer(r'\b(?:src|href)="([^"]+)"', html):
+            mark(resolve(page_dir, m.group(1), root))
+    while todo:
+        asset = todo.pop()
+        if not asset.endswith(('.css', '.js')):
+            continue
+        with open(os.path.join(root, asset), encoding='utf-8',
+                  errors='replace') as f:
+            text = f.read()
+        if asset.endswith('.css'):
+            for m in list(URL_RE.finditer(text)) + list(IMPORT_RE.finditer(text)):
+                mark(resolve(os.path.join(root, os.path.dirname(asset)),
+                             m.group(2), root))
+        else:
+            for name in set(FILE_NAME_RE.findall(text)):
+                for candidate in by_name.get(name, []):
+                    mark(candidate)
+    return live
+
+
+def drop_dead_assets(root, live, dry_run):
+    """Remove the files under _static nothing refers to; returns the number
+    of files and bytes.  The gzip and brotli versions compress_site.py
+    writes stay as long as the file they were made from does."""
+    count = size = 0
+    static = os.path.join(root, '_static')
+    for path in glob.glob(os.path.join(static, '**', '*'), recursive=True):
+        asset, ext = os.path.splitext(os.path.relpath(path, root))
+        if ext not in PRECOMPRESSED:
+            asset += ext
+        # Licences ship with the files they cover
+        if (os.path.isfile(path) and asset not in live
+                and not os.path.basename(path).upper().startswith('LICENSE')):
+            count += 1
+            size += os.path.getsize(path)
+            if dry_run:
+                print('Unused:', os.path.relpath(path, root))
+            else:
+                os.remove(path)
+    if not dry_run:
+        for dirpath, dirnames, filenames in sorted(os.walk(static),
+                                                   reverse=True):
+            if dirpath != static and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+    return count, size
+
+
+def page_weight(root, page):
+    """Number of local stylesheets and scripts a page loads, and their
+    total size."""
+    page_dir = os.path.dirname(page)
+    with open(page, encoding='utf-8') as f:
+        html = f.read()
+    assets = set()
+    for m in TAG_RE.finditer(html):
+        attrs = attributes(m.group(0))
+        if attrs.get('rel') == 'preload':
+            continue
+        url = attrs.get('src') or ('stylesheet' in attrs.get('rel', '').split()
+                                   and attrs.get('href'))
+        asset = resolve(page_dir, url or '', root)
+        if asset and os.path.isfile(os.path.join(root, asset)):
+            assets.add(asset)
+    return len(assets), sum(os.path.getsize(os.path.join(root, a))
+                            for a in assets)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bundles the stylesheets \
+        and scripts the pages of the built book load into minified, \
+        fingerprinted files under _static/bundles, points the pages at \
+        them, and removes the files under _static that nothing refers to. \
+        Safe to run again after each build.")
+    parser.add_argument('root', nargs='?', default=HTML_DIR,
+        help='Built HTML directory (default Book/_build/html).')
+    parser.add_argument('--page', help='Page to report the load of (default \
+        landingpage.html).', default='landingpage.html')
+    parser.add_argument('-n', '--dry-run', help='List the unused files \
+        instead of removing them; pages are still bundled.',
+        action='store_true')
+    parser.add_argument('--keep-unused', help='Do not look for unused files.',
+        action='store_true')
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    pages = sorted(p for p in glob.glob(os.path.join(root, '**', '*.html'),
+                                        recursive=True)
+                   if not os.path.relpath(p, root).startswith('_static' + os.sep))
+    first = os.path.join(root, args.page)
+    if os.path.exists(first):
+        before = page_weight(root, first)
+    if rcssmin is None or rjsmin is None:
+        print('rcssmin/rjsmin are not installed: stylesheets are minified '
+              'less, and scripts only concatenated.')
+
+    bundler = Bundler(root)
+    saved = changed = 0
+    for page in pages:
+        with open(page, encoding='utf-8') as f:
+            html = f.read()
+        new, n = bundle_page(html, os.path.dirname(page), root, bundler)
+        if new != html:
+            tmp = '%s.%d.tmp' % (page, os.getpid())
+            with open(tmp, mode='wt', encoding='utf-8') as f:
+                f.write(new)
+            os.replace(tmp, page)
+            changed += 1
+            saved += n
+    print('Bundled the assets of %d pages into %d files, %d fewer requests '
+          'in all.' % (changed, len(set(bundler.bundles.values())), saved))
+
+    if not args.keep_unused:
+        count, size = drop_dead_assets(root, live_assets(root, pages),
+                                       args.dry_run)
+        print('%s %d unused files under _static (%.1f MB).'
+              % ('Found' if args.dry_run else 'Removed', count, size / 1e6))
+    if os.path.exists(first):
+        after = page_weight(root, first)
+        print('%s: %d stylesheets and scripts (%.0f KB) -> %d (%.0f KB)'
+              % (args.page, before[0], before[1] / 1e3, after[0],
+                 after[1] / 1e3))
@@ -0,0 +1,105 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import gzip
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HTML_DIR = os.path.join(HERE, 'Book', '_build', 'html')
+# searchindex.js is covered by .js
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.svg', '.txt', '.xml',
+                '.map')
+MIN_BYTES = 256
+
+
+def compressors(use_brotli):
+    found = [('.gz', lambda data: gzip.compress(data, compresslevel=9,
+                                                  mtime=0))]
+    if use_brotli and brotli is not None:
+        found.append(('.br', lambda data: brotli.compress(
+            data, mode=brotli.MODE_TEXT, quality=11)))
+    return found
+
+
+def compress(path, use_brotli):
+    """Write path.gz (and path.br) unless they are already newer than path.
+    A variant that would not be smaller is not kept.  Returns (bytes of the
+    original, {suffix: bytes of the variant}, number of variants written)."""
+    size = os.path.getsize(path)
+    mtime = os.path.getmtime(path)
+    sizes = {}
+    written = 0
+    data = None
+    for suffix, compressor in compressors(use_brotli):
+        variant = path + suffix
+        if os.path.exists(variant) and os.path.getmtime(variant) >= mtime:
+            sizes[suffix] = os.path.getsize(variant)
+            continue
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        out = compressor(data)
+        if len(out) >= size:
+            if os.path.exists(variant):
+                os.remove(variant)
+            continue
+        tmp = '%s.%d.tmp' % (variant, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(out)
+        os.replace(tmp, variant)
+        sizes[suffix] = len(out)
+        written += 1
+    return size, sizes, written
+
+
+def site_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if (name.endswith(COMPRESSIBLE)
+                    and os.path.getsize(path) >= MIN_BYTES):
+                yield path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes gzip and brotli \
+        versions (FILE.gz, FILE.br) of every HTML, JS, CSS and search index \
+        file of the built book, for serve_book.py or any server that serves \
+        precompressed files. Files whose variants are up to date are \
+        skipped.")
+    parser.add_argument('root', nargs='?', default=HTML_DIR,
+        help='Built HTML directory (default Book/_build/html).')
+    parser.add_argument('-j', '--jobs', help='Number of worker processes \
+        (default: one per CPU).', type=int, default=os.cpu_count())
+    parser.add_argument('--no-brotli', help='Only write gzip versions.',
+        dest='brotli', action='store_false')
+    args = parser.parse_args()
+
+    if args.brotli and brotli is None:
+        print('brotli is not installed: writing gzip versions only.')
+    start = time.perf_counter()
+    paths = sorted(site_files(args.root))
+    total = 0
+    compressed = {}
+    written = 0
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        for size, sizes, n in pool.map(compress, paths,
+                                       [args.brotli] * len(paths),
+                                       chunksize=16):
+            total += size
+            written += n
+            for suffix, variant_size in sizes.items():
+                compressed[suffix] = compressed.get(suffix, 0) + variant_size
+    print('Compressed %d files (%d variants written) in %.1fs.'
+          % (len(paths), written, time.perf_counter() - start))
+    print('Uncompressed: %.1f MB' % (total / 1e6))
+    for suffix, size in sorted(compressed.items()):
+        print('%s: %.1f MB' % (suffix, size / 1e6))
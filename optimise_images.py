@@ -0,0 +1,284 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import glob
+import hashlib
+import io
+import json
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops
+
+try:
+    import pillow_avif  # noqa: F401  Registers AVIF with Pillow < 11.2
+except ImportError:
+    pass
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.path.join(HERE, 'Book', '_build')
+VARIANT_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF'}
+IMG_RE = re.compile(r'<img\b[^>]*?\bsrc="([^"]+\.png)"[^>]*>')
+
+# Set in each worker by init_worker: hash of every PNG seen before -> hash
+# of its optimised version, which maps to itself
+index = {}
+
+# Optimised images and their variants are kept in the content-addressed
+# store of the image_store extension, under the names it gives them, and
+# both trees are hard-linked to them.  A figure therefore stays a single
+# file on disk, and the store's link counts still tell which of its files
+# are in use: the next build removes the ones nothing links to, optimised
+# or not.  A file removed that way is simply encoded again when needed.
+
+
+def init_worker(known):
+    global index
+    index = known
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def same_pixels(a, b):
+    if a.size != b.size:
+        return False
+    mode = 'RGBA' if 'A' in a.getbands() or 'transparency' in a.info else 'RGB'
+    return ImageChops.difference(a.convert(mode), b.convert(mode)).getbbox() is None
+
+
+def encode_png(img):
+    buf = io.BytesIO()
+    img.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+
+def optimise_png(data):
+    """Smallest lossless re-encoding of a PNG: recompressed as it is, with
+    an alpha channel that is opaque everywhere dropped, and with at most 256
+    colours stored as a palette.  Each candidate is checked against the
+    original pixels; returns data itself if nothing is smaller."""
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    candidates = [img]
+    if img.mode == 'RGBA' and img.getextrema()[3] == (255, 255):
+        img = img.convert('RGB')
+        candidates.append(img)
+    if img.mode == 'RGB' and img.getcolors(256) is not None:
+        candidates.append(img.quantize(colors=256,
+                                       method=Image.Quantize.FASTOCTREE))
+    best = data
+    original = candidates[0]
+    for candidate in candidates:
+        encoded = encode_png(candidate)
+        if len(encoded) < len(best) and same_pixels(
+                original, Image.open(io.BytesIO(encoded))):
+            best = encoded
+    return best
+
+
+def write_atomic(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def store_path(store, h, name):
+    return os.path.join(store, h[:2], name)
+
+
+def add_to_store(path, data):
+    """Write data to the store file path unless it exists.  The first writer
+    wins, so every tree links to the same file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+def place(stored, path):
+    """Make path a hard link to the store file, or a copy on a filesystem
+    without hard links.  path is replaced, never written into, and so is
+    every built image (see _ext/image_store.py), so the store never
+    changes through the link."""
+    if os.path.exists(path) and os.path.samefile(stored, path):
+        return
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.link(stored, tmp)
+    except OSError:
+        shutil.copyfile(stored, tmp)
+    os.replace(tmp, path)
+
+
+def optimise(paths, store, variants, quality):
+    """Optimise one PNG in place and write its variants next to it.  paths
+    are links to the same file, e.g. in html/_images and jupyter_execute,
+    which all end up linked to the optimised version.
+
+    Returns (first path, input hash, output hash, bytes before, bytes
+    after, status), where status is 'optimised' if it was encoded here,
+    'cached' if the result of an earlier run was reused and 'unchanged' if
+    the file was already optimised.
+    """
+    path = paths[0]
+    with open(path, 'rb') as f:
+        data = f.read()
+    h = sha256(data)
+    out_h = index.get(h)
+    stored = out_h and store_path(store, out_h, out_h + '.png')
+    if out_h is not None and os.path.exists(stored):
+        status = 'unchanged' if out_h == h else 'cached'
+        size = os.path.getsize(stored)
+    else:
+        status = 'optimised'
+        out = optimise_png(data)
+        out_h = sha256(out)
+        stored = store_path(store, out_h, out_h + '.png')
+        add_to_store(stored, out)
+        size = len(out)
+    for p in paths:
+        place(stored, p)
+
+    for ext in variants:
+        suffix = '' if quality is None else '-q%d' % quality
+        stored_variant = store_path(store, out_h,
+                                    '%s%s.%s' % (out_h, suffix, ext))
+        if not os.path.exists(stored_variant):
+            img = Image.open(stored)
+            img = img.convert('RGBA' if 'A' in img.getbands()
+                              or 'transparency' in img.info else 'RGB')
+            buf = io.BytesIO()
+            if quality is None:
+                img.save(buf, VARIANT_FORMATS[ext], lossless=True, quality=100)
+            else:
+                img.save(buf, VARIANT_FORMATS[ext], quality=quality)
+            add_to_store(stored_variant, buf.getvalue())
+        for p in paths:
+            place(stored_variant, os.path.splitext(p)[0] + '.' + ext)
+    return path, h, out_h, len(data), size, status
+
+
+def picture(html, html_dir, variants):
+    """Wrap every <img> of a PNG that has variants in a <picture>, so that
+    browsers which support them download the smaller files."""
+    def replace(m):
+        src = m.group(1)
+        png = os.path.normpath(os.path.join(html_dir, src))
+        sources = ''.join(
+            '<source srcset="%s.%s" type="image/%s">'
+            % (os.path.splitext(src)[0], ext, ext)
+            for ext in variants
+            if os.path.exists(os.path.splitext(png)[0] + '.' + ext))
+        if not sources or html.endswith('<picture>' + sources, 0, m.start()):
+            return m.group(0)
+        return '<picture>%s%s</picture>' % (sources, m.group(0))
+    return IMG_RE.sub(replace, html)
+
+
+def rewrite_html(html_dir, variants):
+    """Point the pages at the variants; returns the number of pages changed."""
+    changed = 0
+    for path in glob.glob(os.path.join(html_dir, '**', '*.html'), recursive=True):
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        new = picture(html, os.path.dirname(path), variants)
+        if new != html:
+            write_atomic(path, new.encode('utf-8'))
+            changed += 1
+    return changed
+
+
+def load_index(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recompresses the PNG \
+        figures of a built book losslessly, in place, and optionally writes \
+        WebP or AVIF versions next to them. Results are cached by the hash \
+        of each file, so figures that did not change since the last run are \
+        not encoded again.")
+    parser.add_argument('dirs', nargs='*', default=[
+        os.path.join(BUILD_DIR, 'html', '_images'),
+        os.path.join(BUILD_DIR, 'jupyter_execute')],
+        help='Directories of PNGs to optimise (default Book/_build/html/\
+        _images and Book/_build/jupyter_execute).')
+    parser.add_argument('-j', '--jobs', help='Number of worker processes \
+        (default: one per CPU).', type=int, default=os.cpu_count())
+    parser.add_argument('--store', help='Content-addressed store the \
+        optimised images and their variants are kept in and linked from \
+        (default Book/_build/.image_store, shared with the image_store \
+        extension).', default=os.path.join(BUILD_DIR, '.image_store'))
+    parser.add_argument('--cache-dir', help='Where the index of the images \
+        optimised so far is kept (default Book/_build/.image_cache).',
+        default=os.path.join(BUILD_DIR, '.image_cache'))
+    parser.add_argument('--webp', help='Also write a WebP version of every \
+        PNG.', action='store_true')
+    parser.add_argument('--avif', help='Also write an AVIF version of every \
+        PNG (needs Pillow 11.2, or pillow-avif-plugin).', action='store_true')
+    parser.add_argument('--quality', help='Encode the WebP/AVIF versions \
+        lossily at this quality, 0-100 (default: lossless).', type=int,
+        default=None)
+    parser.add_argument('--rewrite-html', help="Wrap the pages' <img> tags \
+        in <picture> elements offering the variants, in this HTML directory \
+        (default Book/_build/html).", nargs='?',
+        const=os.path.join(BUILD_DIR, 'html'), default=None, metavar='HTML_DIR')
+    args = parser.parse_args()
+
+    variants = [ext for ext in ('avif', 'webp') if getattr(args, ext)]
+    os.makedirs(args.cache_dir, exist_ok=True)
+    index_file = os.path.join(args.cache_dir, 'index.json')
+    known = load_index(index_file)
+    paths = sorted(p for d in args.dirs
+                   for p in glob.glob(os.path.join(d, '**', '*.png'),
+                                      recursive=True))
+    # Links to one file, as the image store makes them, are optimised once
+    groups = {}
+    for p in paths:
+        st = os.stat(p)
+        groups.setdefault((st.st_dev, st.st_ino), []).append(p)
+    print('Optimising %d PNGs (%d distinct files) in %s'
+          % (len(paths), len(groups), ', '.join(args.dirs)))
+
+    start = time.perf_counter()
+    counts = {'optimised': 0, 'cached': 0, 'unchanged': 0}
+    before = after = 0
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1),
+                             initializer=init_worker,
+                             initargs=(known,)) as pool:
+        futures = [pool.submit(optimise, group, args.store, variants,
+                               args.quality) for group in groups.values()]
+        for future in futures:
+            path, h, out_h, size_in, size_out, status = future.result()
+            known[h] = known[out_h] = out_h
+            counts[status] += 1
+            before += size_in
+            after += size_out
+    with open(index_file + '.tmp', mode='wt') as f:
+        json.dump(known, f)
+    os.replace(index_file + '.tmp', index_file)
+
+    print('*****')
+    print('%d encoded, %d restored from the cache, %d already optimised, '
+          'in %.1fs.' % (counts['optimised'], counts['cached'],
+                         counts['unchanged'], time.perf_counter() - start))
+    print('PNGs: %.1f MB -> %.1f MB' % (before / 1e6, after / 1e6))
+    if args.rewrite_html and variants:
+        print('Pages pointed at %s versions: %d'
+              % ('/'.join(variants), rewrite_html(args.rewrite_html, variants)))
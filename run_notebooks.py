@@ -2,61 +2,1882 @@
 # coding: utf-8
 
 import os
+import re
+import resource
+import sys
 import argparse
+import base64
+import asyncio
+import ast
+import csv
+import fcntl
 import glob
+import hashlib
+import heapq
+import json
+import multiprocessing
+import mimetypes
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from multiprocessing.util import Finalize
 
 import nbformat
+import nbformat.v4
+from nbformat.validator import iter_validate, normalize
+from jupyter_client import AsyncKernelManager, KernelManager
+from nbclient import NotebookClient
+from nbclient.exceptions import DeadKernelError
+from nbclient.util import run_sync
 from nbconvert.preprocessors import ExecutePreprocessor
 from nbconvert.preprocessors.execute import CellExecutionError
 
-# Parse args
-parser = argparse.ArgumentParser(description="Runs a set of Jupyter \
-                                              notebooks.")
-file_text = """ Notebook file(s) to be run, e.g. '*.ipynb' (default),
-'my_nb1.ipynb', 'my_nb1.ipynb my_nb2.ipynb', 'my_dir/*.ipynb'
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import jupyter_cache
+except ImportError:
+    jupyter_cache = None
+    CacheBundleIn = None
+else:
+    try:
+        from jupyter_cache.base import CacheBundleIn
+    except ImportError:
+        try:
+            # jupyter-cache 0.4 and earlier
+            from jupyter_cache.base import NbBundleIn as CacheBundleIn
+        except ImportError:
+            CacheBundleIn = None  # Checked in main, which refuses to run
+
+
+KERNEL_NAME = 'python3'
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+DATA_FILE_RE = re.compile(r'([\w.-]+\.csv)\b')
+# The chapters read their data from the copy on GitHub, which build.sh only
+# updates after it has run them.  While they execute here these URLs point
+# at the data directory instead, so that outputs, and the hashes they are
+# cached under, always come from the local files.
+DATA_URL_RE = re.compile(
+    r'https?://raw\.githubusercontent\.com/ethanweed/pythonbook/[\w.-]+/Data/'
+    r'([\w.-]+)')
+CACHE_DIR = '.nbcache'
+# Where jupyter-book keeps executed notebooks with execute_notebooks: cache,
+# for the --path-output build.sh uses
+BOOK_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Book',
+                          '_build', '.jupyter_cache')
+
+
+def data_files(nb, data_dir=DATA_DIR):
+    """Return the files in data_dir whose names appear in nb's code cells."""
+    found = set()
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            found.update(DATA_FILE_RE.findall(cell.source))
+    paths = (os.path.join(data_dir, name) for name in found)
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+def local_data_urls(source, data_dir=DATA_DIR):
+    """source with the data URLs of files that data_dir has replaced by
+    their paths there."""
+    def local(m):
+        path = os.path.join(data_dir, m.group(1))
+        return os.path.abspath(path) if os.path.isfile(path) else m.group(0)
+    return DATA_URL_RE.sub(local, source)
+
+
+def cell_hashes(nb, data_dir=DATA_DIR):
+    """Return one hash per code cell, covering that cell's source and
+    everything that ran before it: the earlier code cells, the kernel and the
+    contents of the data files the notebook reads.  Two notebooks that share
+    a hash at some cell have run exactly the same code up to that point."""
+    h = hashlib.sha256()
+    h.update(KERNEL_NAME.encode())
+    for path in data_files(nb, data_dir):
+        with open(path, 'rb') as f:
+            h.update(b'\0' + os.path.basename(path).encode() + b'\0')
+            h.update(f.read())
+    hashes = []
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            h.update(b'\0' + cell.source.encode())
+            hashes.append(h.copy().hexdigest())
+    return hashes
+
+
+def notebook_hash(nb, data_dir=DATA_DIR):
+    """Hash everything that decides a notebook's outputs: the source of its
+    code cells, the kernel it runs on and the contents of the data files it
+    reads."""
+    hashes = cell_hashes(nb, data_dir)
+    if hashes:
+        return hashes[-1]
+    return hashlib.sha256(KERNEL_NAME.encode()).hexdigest()
+
+
+def restore_outputs(nb, cached):
+    """Copy outputs and execution counts from the cached run into nb, so that
+    edits to markdown cells still show up in the _out.ipynb."""
+    cached_code = [c for c in cached.cells if c.cell_type == 'code']
+    code = [c for c in nb.cells if c.cell_type == 'code']
+    for cell, cached_cell in zip(code, cached_code):
+        cell.outputs = cached_cell.outputs
+        cell.execution_count = cached_cell.execution_count
+    if 'language_info' in cached.metadata:
+        nb.metadata['language_info'] = cached.metadata['language_info']
+
+
+# Run silently in the kernel to save or load its global namespace.  dill is
+# used when the kernel has it, since it can pickle functions and classes
+# defined in the notebook itself.  The names IPython puts in the namespace
+# (open, exit, In, ...) are left out, and so are values that cannot be
+# pickled; their names are kept in the snapshot as 'skipped'.
+SNAPSHOT_CODE = """
+def _nb_snapshot(path):
+    import types
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+    hidden = getattr(get_ipython(), 'user_ns_hidden', {})
+    modules, values, skipped = {}, {}, []
+    for k, v in list(globals().items()):
+        if k.startswith('_') or (k in hidden and hidden[k] is v):
+            continue
+        if isinstance(v, types.ModuleType):
+            modules[k] = v.__name__
+            continue
+        try:
+            values[k] = pickle.dumps(v)
+        except Exception:
+            skipped.append(k)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({'modules': modules, 'values': values,
+                     'skipped': skipped}, f)
+    import os
+    os.replace(path + '.tmp', path)
+_nb_snapshot(%r)
+del _nb_snapshot
+"""
+
+# Loads a snapshot, carries on the kernel's execution count from the given
+# number and leaves the names of the values it does not hold, or could not
+# unpickle, in _nb_skipped.
+RESTORE_CODE = """
+def _nb_restore(path, count):
+    import importlib
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+    for k, name in snapshot['modules'].items():
+        globals()[k] = importlib.import_module(name)
+    skipped = snapshot.get('skipped', [])
+    for k, v in snapshot['values'].items():
+        try:
+            globals()[k] = pickle.loads(v)
+        except Exception:
+            skipped.append(k)
+    get_ipython().execution_count = count
+    return skipped
+_nb_skipped = _nb_restore(%r, %d)
+del _nb_restore
 """
-parser.add_argument('file_list', metavar='F', type=str, nargs='*', 
-    help=file_text)
-parser.add_argument('-t', '--timeout', help='Length of time (in secs) a cell \
-    can run before raising TimeoutError (default 600).', default=600, 
-    required=False)
-parser.add_argument('-p', '--run-path', help='The path the notebook will be \
-    run from (default pwd).', default='.', required=False)
-args = parser.parse_args()
-print('Args:', args)
-if not args.file_list: # Default file_list
-    args.file_list = glob.glob('*.ipynb')
-
-# Check list of notebooks
-notebooks = []
-print('Notebooks to run:')
-for f in args.file_list:
-    # Find notebooks but not notebooks previously output from this script
-    if f.endswith('.ipynb') and not f.endswith('_out.ipynb'):
-        print(f[:-6])
-        notebooks.append(f[:-6]) # Want the filename without '.ipynb'
-
-# Execute notebooks and output
-num_notebooks = len(notebooks)
-print('*****')
-for i, n in enumerate(notebooks):
-    n_out = n + '_out'
-    with open(n + '.ipynb') as f:
-        nb = nbformat.read(f, as_version=4)
-        ep = ExecutePreprocessor(timeout=int(args.timeout), kernel_name='python3')
-        try:
-            print('Running', n, ':', i, '/', num_notebooks)
-            out = ep.preprocess(nb, {'metadata': {'path': args.run_path}})
-        except CellExecutionError:
-            out = None
-            msg = 'Error executing the notebook "%s".\n' % n
-            msg += 'See notebook "%s" for the traceback.' % n_out
-            print(msg)
+
+# Calls that change state a checkpoint does not hold, since it only has the
+# kernel's globals: plot styles, random seeds, display and warning options,
+# the working directory.  No notebook resumes past a cell that makes one.
+PROCESS_STATE_RE = re.compile(
+    r'\b(?:sns|seaborn)\.set\w*\(|\brcParams\b|\bplt\.rc\(|\bstyle\.use\('
+    r'|\brandom\.seed\(|\bset_option\(|\bpd\.options\.|\bset_printoptions\('
+    r'|\bwarnings\.(?:filterwarnings|simplefilter)\(|\bos\.chdir\('
+    r'|^\s*%config\b', re.M)
+
+
+def checkpoint_limit(nb):
+    """Number of code cells before the first one that changes process
+    state; checkpoints are only taken and restored before it."""
+    code = [c for c in nb.cells if c.cell_type == 'code']
+    for j, cell in enumerate(code):
+        if PROCESS_STATE_RE.search(cell.source):
+            return j
+    return len(code)
+
+
+class EventSink:
+    """Writes execution events as JSON lines, for tail_events.py to follow.
+
+    target is a file to append to, or 'unix:PATH' for datagrams to a Unix
+    socket that a listener has bound at PATH.  Events to a socket that
+    nobody is listening on are dropped, so they can never hold up a build.
+    """
+
+    def __init__(self, target=None):
+        self.target = target
+        self.file = self.sock = None
+        if target and target.startswith('unix:'):
+            self.address = target[len('unix:'):]
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        elif target:
+            self.file = open(target, 'a')
+
+    def emit(self, event, **fields):
+        if not self.target:
+            return
+        record = {'ts': time.time(), 'event': event,
+                  'host': socket.gethostname(), 'pid': os.getpid()}
+        record.update(fields)
+        line = json.dumps(record) + '\n'
+        if self.file:
+            # One write per line, so lines from several processes never mix
+            os.write(self.file.fileno(), line.encode())
+        else:
+            try:
+                self.sock.sendto(line.encode(), self.address)
+            except OSError:
+                pass
+
+
+events = EventSink()
+
+
+def open_events(args):
+    """Point this process's events at args.events."""
+    global events
+    if args.events != events.target:
+        events = EventSink(args.events)
+
+
+# Evaluated in the kernel around each profiled cell: CPU seconds used so far
+# and the peak resident set size in bytes (ru_maxrss is in KiB on Linux).
+USAGE_EXPRESSION = ("[(r.ru_utime + r.ru_stime, r.ru_maxrss * "
+                    "(1 if __import__('sys').platform == 'darwin' else 1024)) "
+                    "for r in [__import__('resource').getrusage(0)]][0]")
+
+
+class BookExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor that reports the code cells it runs to the event
+    stream and can profile them.
+
+    With profile set, every executed code cell gets a record of its wall
+    time, the kernel's CPU time, how far it raised the kernel's peak RSS and
+    the size of its outputs, collected in cell_profiles.
+    """
+
+    def __init__(self, profile=False, notebook_name='', data_dir=DATA_DIR,
+                 **kw):
+        super().__init__(**kw)
+        self.profile_cells = profile
+        self.cell_profiles = []
+        self.notebook_name = notebook_name
+        self.data_dir = data_dir
+
+    async def async_preprocess(self, nb, resources, km):
+        """Awaitable counterpart of preprocess, for running several notebooks
+        on one event loop.  km must be an AsyncKernelManager."""
+        NotebookClient.__init__(self, nb, km)
+        self.resources = resources
+        await self.async_execute()
+        return self.nb, self.resources
+
+    async def async_run_hidden(self, code, user_expressions=None):
+        """Run code in the kernel without touching the notebook and return
+        the execute reply's content, or None if it did not succeed."""
+        msg_id = self.kc.execute(code, silent=True, store_history=False,
+                                 user_expressions=user_expressions or {})
+        reply = await self.async_wait_for_reply(msg_id)
+        if reply is None or reply['content']['status'] != 'ok':
+            return None
+        return reply['content']
+
+    async def kernel_usage(self):
+        try:
+            content = await self.async_run_hidden('', {'usage': USAGE_EXPRESSION})
+            value = content['user_expressions']['usage']
+            return ast.literal_eval(value['data']['text/plain'])
+        except Exception:
+            return None, None
+
+    async def async_execute_cell(self, cell, cell_index, execution_count=None,
+                                 store_history=True):
+        if cell.cell_type != 'code':
+            return await super().async_execute_cell(
+                cell, cell_index, execution_count, store_history)
+        events.emit('cell_start', notebook=self.notebook_name, cell=cell_index)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            cell = await self.profiled_execute_cell(
+                cell, cell_index, execution_count, store_history)
+            status = 'ok'
+            return cell
         except TimeoutError:
-            msg = 'Timeout executing the notebook "%s".\n' % n
-            print(msg)
+            status = 'timeout'
+            raise
+        finally:
+            events.emit('cell_end', notebook=self.notebook_name,
+                        cell=cell_index, status=status,
+                        seconds=time.perf_counter() - start)
+
+    async def run_cell(self, cell, cell_index, execution_count,
+                       store_history):
+        """Execute cell reading its data from data_dir (see DATA_URL_RE);
+        the notebook keeps the original source."""
+        source = cell.source
+        cell.source = local_data_urls(source, self.data_dir)
+        try:
+            return await super().async_execute_cell(
+                cell, cell_index, execution_count, store_history)
+        finally:
+            cell.source = source
+
+    async def profiled_execute_cell(self, cell, cell_index, execution_count,
+                                    store_history):
+        execute = self.run_cell
+        if not self.profile_cells:
+            return await execute(cell, cell_index, execution_count,
+                                 store_history)
+        cpu_before, rss_before = await self.kernel_usage()
+        start = time.perf_counter()
+        try:
+            return await execute(cell, cell_index, execution_count,
+                                 store_history)
+        finally:
+            wall = time.perf_counter() - start
+            cpu_after, rss_after = await self.kernel_usage()
+            lines = cell.source.strip().splitlines()
+            self.cell_profiles.append({
+                'cell': cell_index,
+                'execution_count': cell.get('execution_count'),
+                'first_line': lines[0][:60] if lines else '',
+                'source_hash': hashlib.sha1(cell.source.encode()).hexdigest(),
+                'wall_seconds': wall,
+                'cpu_seconds': (cpu_after - cpu_before
+                                if cpu_after is not None
+                                and cpu_before is not None else None),
+                'peak_rss_delta_bytes': (rss_after - rss_before
+                                         if rss_after is not None
+                                         and rss_before is not None else None),
+                'output_bytes': len(json.dumps(cell.get('outputs', []))),
+            })
+
+    # preprocess_cell calls execute_cell, which must go through the override
+    execute_cell = run_sync(async_execute_cell)
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class IncrementalExecutePreprocessor(BookExecutePreprocessor):
+    """ExecutePreprocessor that skips the unchanged head of a notebook.
+
+    The outputs of every executed code cell are stored under the cell's hash
+    (see cell_hashes), and the kernel namespace is pickled after every
+    checkpoint_every-th code cell and after every cell that calls glue.  A
+    later run restores the stored outputs up to the last checkpoint whose
+    hash still matches, loads that namespace into a fresh kernel and only
+    executes the cells after it.  Only the cells before limit (see
+    checkpoint_limit) are checkpointed.
+    """
+
+    def __init__(self, cache_dir, hashes, checkpoint_every, limit, **kw):
+        super().__init__(**kw)
+        self.cells_dir = os.path.join(cache_dir, 'cells')
+        self.checkpoints_dir = os.path.join(cache_dir, 'checkpoints')
+        self.hashes = hashes
+        self.checkpoint_every = checkpoint_every
+        self.limit = limit
+        self.resume_from = self.find_resume_point()
+        self.code_index = {}
+        self.cells_skipped = 0
+
+    def cell_file(self, h):
+        return os.path.join(self.cells_dir, h + '.json')
+
+    def checkpoint_file(self, h):
+        return os.path.join(self.checkpoints_dir, h + '.pkl')
+
+    def find_resume_point(self):
+        """Index of the last code cell that can be restored, or -1."""
+        stored = 0
+        while (stored < len(self.hashes)
+               and os.path.exists(self.cell_file(self.hashes[stored]))):
+            stored += 1
+        for j in range(min(stored, self.limit) - 1, -1, -1):
+            if os.path.exists(self.checkpoint_file(self.hashes[j])):
+                return j
+        return -1
+
+    async def async_execute_cell(self, cell, cell_index, execution_count=None,
+                                 store_history=True):
+        if cell.cell_type != 'code':
+            return cell
+        j = self.code_index.setdefault(cell_index, len(self.code_index))
+        h = self.hashes[j]
+        if j <= self.resume_from:
+            with open(self.cell_file(h)) as f:
+                stored = json.load(f)
+            cell.outputs = [nbformat.from_dict(o) for o in stored['outputs']]
+            cell.execution_count = stored['execution_count']
+            self.cells_skipped += 1
+            # As the base class does, so the cells that run next are
+            # numbered on from here
+            self.code_cells_executed += 1
+            if j == self.resume_from:
+                await self.restore_checkpoint(j, h)
+            return cell
+
+        cell = await super().async_execute_cell(cell, cell_index,
+                                                execution_count, store_history)
+        os.makedirs(self.cells_dir, exist_ok=True)
+        tmp = '%s.%d.tmp' % (self.cell_file(h), os.getpid())
+        with open(tmp, mode='wt') as f:
+            json.dump({'outputs': cell.outputs,
+                       'execution_count': cell.execution_count}, f)
+        os.replace(tmp, self.cell_file(h))
+        if j < self.limit and ((j + 1) % self.checkpoint_every == 0
+                               or 'glue(' in cell.source):
+            os.makedirs(self.checkpoints_dir, exist_ok=True)
+            await self.async_run_hidden(
+                SNAPSHOT_CODE % os.path.abspath(self.checkpoint_file(h)))
+        return cell
+
+    async def restore_checkpoint(self, j, h):
+        """Load the namespace saved after code cell j into the kernel.  Raises
+        CheckpointError, and removes the checkpoint, if it cannot be loaded or
+        lacks a value that a later cell uses."""
+        path = os.path.abspath(self.checkpoint_file(h))
+        content = await self.async_run_hidden(RESTORE_CODE % (path, j + 2),
+                                              {'skipped': '_nb_skipped'})
+        try:
+            value = content['user_expressions']['skipped']
+            skipped = ast.literal_eval(value['data']['text/plain'])
+        except (TypeError, KeyError, ValueError, SyntaxError):
+            skipped = None
+        await self.async_run_hidden('del _nb_skipped')
+        later = [c.source for c in self.nb.cells
+                 if c.cell_type == 'code'][j + 1:]
+        missing = [k for k in skipped or []
+                   if any(re.search(r'\b%s\b' % re.escape(k), source)
+                          for source in later)]
+        if skipped is None or missing:
+            os.remove(path)
+            raise CheckpointError(path + (' (does not hold %s)'
+                                          % ', '.join(missing)
+                                          if missing else ''))
+
+    execute_cell = run_sync(async_execute_cell)
+
+
+# The libraries the chapters import in their first cells.  Warm kernels
+# import them up front without binding any names, so the notebook's own
+# imports find them in sys.modules.
+PRELOAD_MODULES = ('numpy', 'pandas', 'matplotlib.pyplot', 'seaborn',
+                   'scipy.stats', 'pingouin', 'statsmodels.api',
+                   'statsmodels.formula.api')
+
+PRELOAD_CODE = """
+import importlib as _importlib
+for _m in %r:
+    try:
+        _importlib.import_module(_m)
+    except ImportError:
+        pass
+del _importlib, _m
+"""
+
+
+# Read by numpy/scipy's BLAS and OpenMP runtimes when the kernel starts.
+# Unset, every kernel starts one thread per core, which oversubscribes the
+# machine as soon as several kernels run at once.
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def parse_size(text):
+    """'512M' or '4G' (or a plain number of bytes) to bytes."""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_cpus(text):
+    """'0-3,8' to [0, 1, 2, 3, 8]."""
+    cpus = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+
+def worker_limits(args, index=0, count=1):
+    """The settings for the kernels of worker number index out of count.
+
+    With --cpu-affinity auto the CPUs this process may use are split into
+    count equal slices and the worker gets slice index, so workers packed on
+    one machine do not compete for cores.
+    """
+    limits = {}
+    if args.kernel_memory:
+        limits['memory_bytes'] = parse_size(args.kernel_memory)
+    if args.cpu_affinity == 'auto' and hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+        size = max(len(available) // max(count, 1), 1)
+        start = (index * size) % len(available)
+        limits['cpus'] = available[start:start + size]
+    elif args.cpu_affinity and args.cpu_affinity != 'auto':
+        limits['cpus'] = parse_cpus(args.cpu_affinity)
+    threads = args.kernel_threads
+    if threads is None and 'cpus' in limits:
+        threads = len(limits['cpus'])
+    if threads:
+        limits['threads'] = threads
+    return limits
+
+
+def kernel_env(limits):
+    env = dict(os.environ)
+    if limits.get('threads'):
+        for var in THREAD_ENV_VARS:
+            env[var] = str(limits['threads'])
+    return env
+
+
+def kernel_pid(km):
+    provisioner = getattr(km, 'provisioner', None)
+    if provisioner is not None:
+        return provisioner.pid
+    return km.kernel.pid
+
+
+def apply_limits(km, limits):
+    """Cap the started kernel's address space and pin all its threads to the
+    CPUs in limits.  Both need Linux; elsewhere only the thread count, which
+    is set through the environment at start-up, takes effect."""
+    pid = kernel_pid(km)
+    if 'memory_bytes' in limits and hasattr(resource, 'prlimit'):
+        cap = limits['memory_bytes']
+        resource.prlimit(pid, resource.RLIMIT_AS, (cap, cap))
+    if 'cpus' in limits and hasattr(os, 'sched_setaffinity'):
+        task_dir = '/proc/%d/task' % pid
+        tids = os.listdir(task_dir) if os.path.isdir(task_dir) else [pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(int(tid), limits['cpus'])
+            except OSError:
+                pass  # The thread has already exited
+
+
+def describe_limits(limits):
+    parts = []
+    if 'memory_bytes' in limits:
+        parts.append('mem=%.1fG' % (limits['memory_bytes'] / 2**30))
+    if 'threads' in limits:
+        parts.append('threads=%d' % limits['threads'])
+    if 'cpus' in limits:
+        cpus = limits['cpus']
+        if cpus == list(range(cpus[0], cpus[-1] + 1)):
+            parts.append('cpus=%d-%d' % (cpus[0], cpus[-1]))
+        else:
+            parts.append('cpus=' + ','.join(map(str, cpus)))
+    return ' '.join(parts) or '-'
+
+
+class KernelPool:
+    """Kernels started ahead of the notebooks that will use them.
+
+    Each kernel runs one notebook and is then shut down, so every notebook
+    still gets a fresh namespace.  A replacement is started and warmed up in
+    the background as soon as a kernel is handed out, so kernel startup and
+    the preload imports overlap with the previous notebook's execution.
+    Nothing is started before the first kernel is asked for, so a run
+    restored entirely from the cache starts none.  With size 0 kernels are
+    started cold, on demand.
+    """
+
+    def __init__(self, size, cwd, limits=None, preload=PRELOAD_MODULES,
+                 kernel_name=KERNEL_NAME):
+        self.size = size
+        self.cwd = cwd
+        self.limits = limits or {}
+        self.preload = preload
+        self.kernel_name = kernel_name
+        self.pending = deque()
+        self.executor = None
+
+    def fill(self):
+        """Start warming up the pool's kernels, the first time only."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.size)
+            for _ in range(self.size):
+                self.pending.append(self.executor.submit(self.start_kernel))
+
+    def start_kernel(self, warm=True, cwd=None):
+        """Start a kernel in cwd (default the pool's) and return (km,
+        seconds to start and warm it)."""
+        start = time.perf_counter()
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel(cwd=cwd or self.cwd, env=kernel_env(self.limits))
+        apply_limits(km, self.limits)
+        kc = km.blocking_client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=60)
+            if warm and self.preload:
+                kc.execute_interactive(PRELOAD_CODE % (self.preload,),
+                                       silent=True, store_history=False,
+                                       output_hook=lambda msg: None)
+        finally:
+            kc.stop_channels()
+        return km, time.perf_counter() - start
+
+    def get(self, cwd=None):
+        """Return (km, startup, wait): a started kernel, the seconds it took
+        to start, and the seconds the caller actually waited for it.  A
+        kernel for another directory than the pool's is started cold."""
+        start = time.perf_counter()
+        other_dir = (cwd is not None
+                     and os.path.abspath(cwd) != os.path.abspath(self.cwd))
+        if not self.size or other_dir:
+            km, startup = self.start_kernel(warm=False, cwd=cwd)
+            return km, startup, startup
+        self.fill()
+        future = self.pending.popleft()
+        self.pending.append(self.executor.submit(self.start_kernel))
+        km, startup = future.result()
+        return km, startup, time.perf_counter() - start
+
+    def shutdown(self):
+        while self.pending:
+            try:
+                km, _ = self.pending.popleft().result()
+                km.shutdown_kernel(now=True)
+            except Exception:
+                pass
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+kernel_pool = None
+
+
+def init_worker(args, counter=None, count=1):
+    """Give this process its own kernel pool.  counter, if given, is a shared
+    multiprocessing.Value that numbers the count workers being started."""
+    global kernel_pool
+    open_events(args)
+    index = 0
+    if counter is not None:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+    kernel_pool = KernelPool(args.warm_kernels, args.run_path,
+                             worker_limits(args, index, count))
+    Finalize(kernel_pool, kernel_pool.shutdown, exitpriority=10)
+
+
+def profiling(args):
+    return bool(args.profile or args.baseline)
+
+
+def is_binary_mimetype(mime):
+    """Jupyter stores these base64 encoded."""
+    return ((mime.startswith('image/') and mime != 'image/svg+xml')
+            or mime == 'application/pdf')
+
+
+def externalise_outputs(nb, store, min_bytes, nb_dir):
+    """Move output data of at least min_bytes into the content-addressed
+    store, leaving only a reference in the notebook.
+
+    Each payload is written once to store/<sha256>.<ext>, so identical
+    figures from different cells, chapters or runs share one file.  The
+    data value in the notebook becomes '' and the file name goes into the
+    output's metadata under 'external'; the notebook's metadata records where
+    the store is, relative to the notebook.  text/plain and JSON data are
+    always kept inline.
+    """
+    os.makedirs(store, exist_ok=True)
+    for cell in nb.cells:
+        for output in cell.get('outputs', []):
+            data = output.get('data', {})
+            external = output.get('metadata', {}).get('external', {})
+            for mime, value in data.items():
+                if (mime == 'text/plain' or mime in external
+                        or not isinstance(value, str)
+                        or len(value) < min_bytes):
+                    continue
+                if is_binary_mimetype(mime):
+                    raw = base64.b64decode(value)
+                else:
+                    raw = value.encode()
+                ext = mimetypes.guess_extension(mime) or '.bin'
+                name = hashlib.sha256(raw).hexdigest() + ext
+                path = os.path.join(store, name)
+                if not os.path.exists(path):
+                    tmp = '%s.%d.tmp' % (path, os.getpid())
+                    with open(tmp, 'wb') as f:
+                        f.write(raw)
+                    os.replace(tmp, path)
+                data[mime] = ''
+                external[mime] = name
+            if external:
+                output.setdefault('metadata', {})['external'] = external
+    nb.metadata['external_outputs'] = os.path.relpath(store, nb_dir)
+
+
+def inline_outputs(nb, nb_dir):
+    """Undo externalise_outputs, reading the data back from the store."""
+    store = os.path.join(nb_dir, nb.metadata.pop('external_outputs'))
+    for cell in nb.cells:
+        for output in cell.get('outputs', []):
+            external = output.get('metadata', {}).pop('external', {})
+            for mime, name in external.items():
+                with open(os.path.join(store, name), 'rb') as f:
+                    raw = f.read()
+                if is_binary_mimetype(mime):
+                    output['data'][mime] = base64.b64encode(raw).decode()
+                else:
+                    output['data'][mime] = raw.decode()
+
+
+def sweep_external_outputs(store, notebooks):
+    """Remove the files in store that none of the given notebook files
+    refers to; returns their number and total size."""
+    store = os.path.realpath(store)
+    used = set()
+    for path in notebooks:
+        try:
+            with open(path, 'rb') as f:
+                d = json.loads(f.read())
+        except (OSError, ValueError):
+            continue
+        rel = d.get('metadata', {}).get('external_outputs')
+        if rel is None or os.path.realpath(os.path.join(
+                os.path.dirname(os.path.abspath(path)), rel)) != store:
+            continue
+        for cell in d.get('cells', []):
+            for output in cell.get('outputs', []):
+                used.update(output.get('metadata', {})
+                            .get('external', {}).values())
+    removed = size = 0
+    for name in os.listdir(store):
+        path = os.path.join(store, name)
+        if (name not in used and not name.endswith('.tmp')
+                and os.path.isfile(path)):
+            size += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+    return removed, size
+
+
+def fast_io(args):
+    return args is not None and args.fast_io
+
+
+def read_notebook(path, args=None):
+    """Read a notebook, pulling any externalised outputs back in.
+
+    With args.fast_io, v4 notebooks are parsed with orjson (when installed)
+    and not validated; anything else goes through nbformat.read.  Missing
+    or duplicate cell ids are repaired either way, as nbformat.read does.
+    """
+    nb = None
+    if fast_io(args):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        d = orjson.loads(raw) if orjson else json.loads(raw)
+        if d.get('nbformat') == 4:
+            ids = [c.get('id') for c in d.get('cells', [])]
+            if (d.get('nbformat_minor', 0) >= 5
+                    and (None in ids or len(set(ids)) < len(ids))):
+                _, d = normalize(d)
+            nb = nbformat.v4.to_notebook_json(d)
+    if nb is None:
+        with open(path) as f:
+            nb = nbformat.read(f, as_version=4)
+    if 'external_outputs' in nb.metadata:
+        inline_outputs(nb, os.path.dirname(os.path.abspath(path)))
+    return nb
+
+
+def write_notebook(nb, path, args=None):
+    """Write a notebook, with large outputs moved to args.external_outputs
+    if that is set.
+
+    The notebook goes to a temporary file that then replaces path, so readers
+    never see it half written.  With args.fast_io it is serialised by the
+    nbformat v4 JSON writer without validating it first, which gives the
+    same bytes as nbformat.write.
+    """
+    if args is not None and args.external_outputs:
+        externalise_outputs(nb, args.external_outputs,
+                            args.external_min_bytes,
+                            os.path.dirname(os.path.abspath(path)))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, mode='wt', encoding='utf-8') as f:
+        if fast_io(args):
+            s = nbformat.v4.writes_json(nb)
+            f.write(s)
+            if not s.endswith('\n'):
+                f.write('\n')
+        else:
+            nbformat.write(nb, f)
+    os.replace(tmp, path)
+
+
+def validate_outputs(paths):
+    """Validate notebooks written with --fast-io, once the run is over.  The
+    JSON is checked as written: nbformat.read and nbformat.validate would
+    repair missing cell ids first."""
+    invalid = 0
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            error = next(iter_validate(json.load(f)), None)
+        if error is not None:
+            invalid += 1
+            print('Invalid notebook %s: %s' % (path, error.message))
+    return invalid
+
+
+def book_cache(args):
+    """The jupyter-cache store the book build executes into, or None."""
+    if not args.book_cache or jupyter_cache is None:
+        return None
+    return jupyter_cache.get_cache(args.book_cache)
+
+
+def book_cache_record(nb, key, args):
+    """Return the book cache's record for nb, if it holds one executed with
+    the inputs key was computed from.
+
+    jupyter-cache matches notebooks on their code cells and kernel only, so
+    the notebook_hash of the run is kept in the record's data, and records
+    made without it (by jupyter-book itself) or with other data files do not
+    count."""
+    cache = book_cache(args)
+    if cache is None:
+        return None
+    try:
+        record = cache.match_cache_notebook(nb)
+    except KeyError:
+        return None
+    if (record.data or {}).get('notebook_hash') != key:
+        return None
+    return record
+
+
+def store_in_book_cache(nb, n, key, args):
+    """Add the executed nb to the book cache, replacing any copy run with
+    other data files, so the next book build does not execute it.  nb must
+    have its outputs inline."""
+    cache = book_cache(args)
+    if cache is None:
+        return
+    os.makedirs(args.book_cache, exist_ok=True)
+    # jupyter-cache keeps its index in SQLite; one writer at a time
+    with open(os.path.join(args.book_cache, 'run_notebooks.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if book_cache_record(nb, key, args) is not None:
+            return
+        cache.cache_notebook_bundle(
+            CacheBundleIn(nb, os.path.abspath(n + '.ipynb'),
+                       data={'notebook_hash': key}),
+            check_validity=False, overwrite=True)
+
+
+def find_cached(nb, key, args):
+    """Return an executed copy of nb run with the inputs key stands for,
+    from the cache directory or the book cache, or None."""
+    if not args.cache_dir:
+        return None
+    cache_file = os.path.join(args.cache_dir, key + '.ipynb')
+    if os.path.exists(cache_file):
+        try:
+            return read_notebook(cache_file, args)
+        except FileNotFoundError:
+            pass  # Its outputs have gone from the external store: run it
+    record = book_cache_record(nb, key, args)
+    if record is not None:
+        return book_cache(args).get_cache_bundle(record.pk).nb
+    return None
+
+
+def load_notebook(n, args, result):
+    """Read notebook n and look it up in the caches.  Returns (nb,
+    cache_file); on a cache hit the _out.ipynb has already been written, the
+    book cache is up to date and result's status is 'cached'."""
+    nb = read_notebook(n + '.ipynb', args)
+    key = result['hash'] = notebook_hash(nb, args.data_dir)
+    cache_file = None
+    if args.cache_dir:
+        cache_file = os.path.join(args.cache_dir, key + '.ipynb')
+        cached = find_cached(nb, key, args)
+        if cached is not None:
+            restore_outputs(nb, cached)
+            store_in_book_cache(nb, n, key, args)
+            write_notebook(nb, n + '_out.ipynb', args)
+            result['status'] = 'cached'
+            mark_notebook(args, n, 'done', key, 'cached')
+            return nb, cache_file
+    mark_notebook(args, n, 'running', key)
+    return nb, cache_file
+
+
+def make_preprocessor(n, nb, args, cache_file, incremental=True):
+    if incremental and cache_file and args.checkpoint_every > 0:
+        return IncrementalExecutePreprocessor(
+            args.cache_dir, cell_hashes(nb, args.data_dir),
+            args.checkpoint_every, checkpoint_limit(nb),
+            profile=profiling(args), notebook_name=n, data_dir=args.data_dir,
+            timeout=int(args.timeout), kernel_name=KERNEL_NAME)
+    return BookExecutePreprocessor(profile=profiling(args), notebook_name=n,
+                                   data_dir=args.data_dir,
+                                   timeout=int(args.timeout),
+                                   kernel_name=KERNEL_NAME)
+
+
+def print_failure(n, status):
+    events.emit(status, notebook=n)
+    if status == 'error':
+        msg = 'Error executing the notebook "%s".\n' % n
+        msg += 'See notebook "%s" for the traceback.' % (n + '_out')
+    elif status == 'killed':
+        msg = 'The kernel died executing the notebook "%s".\n' % n
+        msg += 'It may have run out of memory (see --kernel-memory).'
+    else:
+        msg = 'Timeout executing the notebook "%s".\n' % n
+    print(msg)
+
+
+def finish_notebook(n, nb, ep, args, cache_file, result):
+    """Write the executed notebook to _out.ipynb, store it in the cache if it
+    ran cleanly, and fill in the rest of result."""
+    result['cells_restored'] = getattr(ep, 'cells_skipped', 0)
+    if ep.profile_cells:
+        result['cells'] = ep.cell_profiles
+    if result['cells_restored']:
+        print('Restored %d cells of "%s" from checkpoint.'
+              % (result['cells_restored'], n))
+    # Only successful runs are worth replaying.  The book cache gets the
+    # notebook before write_notebook moves any outputs out of it.
+    if result['status'] == 'ok':
+        store_in_book_cache(nb, n, result['hash'], args)
+
+    # Write output file
+    write_notebook(nb, n + '_out.ipynb', args)
+
+    if cache_file and result['status'] == 'ok':
+        os.makedirs(args.cache_dir, exist_ok=True)
+        write_notebook(nb, cache_file, args)
+    mark_notebook(args, n, 'done' if result['status'] == 'ok' else 'failed',
+                  result['hash'], result['status'])
+    return result
+
+
+def load_manifest(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_manifest(path, updates):
+    """Merge updates ({notebook: fields}) into the run manifest at path.
+
+    The manifest is locked while it is rewritten, so worker processes can
+    record their progress as they go; the new version replaces the old one
+    atomically, so an interrupted run never leaves it half written.
+    """
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_manifest(path)
+        for n, fields in updates.items():
+            manifest.setdefault(n, {}).update(fields)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, mode='wt') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+
+def mark_notebook(args, n, state, key, status=None):
+    """Record n as 'pending', 'running', 'done' or 'failed' in the manifest,
+    together with the hash of the inputs it was run with."""
+    if not args.manifest:
+        return
+    fields = {'state': state, 'hash': key,
+              'updated': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if status:
+        fields['status'] = status
+    update_manifest(args.manifest, {n: fields})
+
+
+def up_to_date(n, entry, args):
+    """Whether a manifest entry says n is done with its current inputs."""
+    return (entry.get('state') == 'done'
+            and os.path.exists(n + '_out.ipynb')
+            and entry.get('hash') == notebook_hash(
+                read_notebook(n + '.ipynb', args), args.data_dir))
+
+
+def start_notebook(n, nb):
+    events.emit('notebook_start', notebook=n,
+                cells=sum(1 for c in nb.cells if c.cell_type == 'code'))
+
+
+def end_notebook(result):
+    events.emit('notebook_end', notebook=result['notebook'],
+                status=result['status'], seconds=result['seconds'])
+    return result
+
+
+def new_result(n):
+    return {'notebook': n, 'status': 'ok', 'seconds': 0.0,
+            'kernel_startup': 0.0, 'kernel_wait': 0.0}
+
+
+def failed_result(n, error):
+    """The result of a notebook whose run broke off with error."""
+    print('Running "%s" failed: %r' % (n, error))
+    result = new_result(n)
+    result.update(status='error', error=repr(error))
+    return result
+
+
+def run_notebook(n, args):
+    """Execute notebook n (given without '.ipynb') and write n + '_out.ipynb'.
+
+    Returns a dict with the notebook name, its status ('ok', 'cached',
+    'error', 'timeout' or 'killed'), the seconds it took, and the seconds
+    spent
+    starting its kernel and waiting for it.
+    """
+    start = time.perf_counter()
+    result = new_result(n)
+    nb, cache_file = load_notebook(n, args, result)
+    if result['status'] == 'cached':
+        result['seconds'] = time.perf_counter() - start
+        return end_notebook(result)
+
+    start_notebook(n, nb)
+    km, result['kernel_startup'], result['kernel_wait'] = kernel_pool.get(
+        args.run_path)
+    result['kernel_limits'] = kernel_pool.limits
+    resources = {'metadata': {'path': args.run_path}}
+    ep = make_preprocessor(n, nb, args, cache_file)
+    try:
+        try:
+            ep.preprocess(nb, resources, km=km)
+        except CheckpointError as e:
+            # The namespace could not be loaded back, so run from the top
+            print('Could not restore checkpoint %s, running "%s" in full.'
+                  % (e, n))
+            nb = read_notebook(n + '.ipynb', args)
+            # A new kernel from the pool, with the same limits and preload
+            km.shutdown_kernel(now=True)
+            km, startup, wait = kernel_pool.get(args.run_path)
+            result['kernel_startup'] += startup
+            result['kernel_wait'] += wait
+            ep = make_preprocessor(n, nb, args, cache_file, incremental=False)
+            ep.preprocess(nb, resources, km=km)
+    except CellExecutionError:
+        result['status'] = 'error'
+        print_failure(n, 'error')
+    except TimeoutError:
+        result['status'] = 'timeout'
+        print_failure(n, 'timeout')
+    except DeadKernelError:
+        # e.g. killed at its memory cap
+        result['status'] = 'killed'
+        print_failure(n, 'killed')
+    except BaseException:
+        # e.g. an interrupted run: never record it as done
+        result['status'] = 'error'
+        raise
+    finally:
+        km.shutdown_kernel(now=True)
+        finish_notebook(n, nb, ep, args, cache_file, result)
+    result['seconds'] = time.perf_counter() - start
+    return end_notebook(result)
+
+
+async def start_async_kernel(cwd, limits):
+    """Start a cold kernel in cwd for the event-loop engine, with limits
+    applied, and wait until it is ready, as KernelPool.start_kernel does."""
+    km = AsyncKernelManager(kernel_name=KERNEL_NAME)
+    await km.start_kernel(cwd=cwd, env=kernel_env(limits))
+    apply_limits(km, limits)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        await kc.wait_for_ready(timeout=60)
+    except BaseException:
+        await km.shutdown_kernel(now=True)
+        raise
+    finally:
+        kc.stop_channels()
+    return km
+
+
+async def run_notebook_async(n, args, slots, free):
+    """Coroutine version of run_notebook for the event-loop engine.
+
+    At most slots notebooks execute at once, each taking a slot number from
+    free for its CPU share.  Reading and hashing happen
+    before a slot is taken, and serialising and writing the output after it
+    is released, both in the loop's thread pool, so they overlap with the
+    execution of other notebooks.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    result = new_result(n)
+    nb, cache_file = await loop.run_in_executor(None, load_notebook, n, args,
+                                                result)
+    if result['status'] == 'cached':
+        result['seconds'] = time.perf_counter() - start
+        return end_notebook(result)
+
+    resources = {'metadata': {'path': args.run_path}}
+    async with slots:
+        slot = free.pop()
+        try:
+            print('Running', n)
+            start_notebook(n, nb)
+            wait_start = time.perf_counter()
+            limits = worker_limits(args, slot, args.async_jobs)
+            km = await start_async_kernel(args.run_path, limits)
+            result['kernel_limits'] = limits
+            result['kernel_startup'] = time.perf_counter() - wait_start
+            result['kernel_wait'] = result['kernel_startup']
+            ep = make_preprocessor(n, nb, args, cache_file)
+            try:
+                try:
+                    await ep.async_preprocess(nb, resources, km)
+                except CheckpointError as e:
+                    print('Could not restore checkpoint %s, running "%s" in '
+                          'full.' % (e, n))
+                    nb = read_notebook(n + '.ipynb', args)
+                    await km.shutdown_kernel(now=True)
+                    restart = time.perf_counter()
+                    km = await start_async_kernel(args.run_path, limits)
+                    result['kernel_startup'] += time.perf_counter() - restart
+                    result['kernel_wait'] = result['kernel_startup']
+                    ep = make_preprocessor(n, nb, args, cache_file,
+                                           incremental=False)
+                    await ep.async_preprocess(nb, resources, km)
+            except CellExecutionError:
+                result['status'] = 'error'
+                print_failure(n, 'error')
+            except TimeoutError:
+                result['status'] = 'timeout'
+                print_failure(n, 'timeout')
+            except DeadKernelError:
+                result['status'] = 'killed'
+                print_failure(n, 'killed')
+            except BaseException:
+                result['status'] = 'error'
+                raise
+            finally:
+                await km.shutdown_kernel(now=True)
+        finally:
+            free.append(slot)
+    await loop.run_in_executor(None, finish_notebook, n, nb, ep, args,
+                               cache_file, result)
+    result['seconds'] = time.perf_counter() - start
+    return end_notebook(result)
+
+
+async def run_all_async(notebooks, args):
+    slots = asyncio.Semaphore(args.async_jobs)
+    free = list(range(args.async_jobs))
+
+    async def run(n):
+        try:
+            return await run_notebook_async(n, args, slots, free)
+        except Exception as e:
+            return failed_result(n, e)
+
+    tasks = [asyncio.ensure_future(run(n)) for n in notebooks]
+    results = []
+    for i, task in enumerate(asyncio.as_completed(tasks)):
+        r = await task
+        print('Finished', r['notebook'], ':', i + 1, '/', len(notebooks),
+              '(%s, %.1fs)' % (r['status'], r['seconds']))
+        results.append(r)
+    return results
+
+
+def print_report(results):
+    print('*****')
+    print('Notebook status:')
+    print('%-50s %-8s %9s %9s %9s  %s' % ('notebook', 'status', 'total',
+                                          'startup', 'waited', 'limits'))
+    for r in results:
+        print('%-50s %-8s %8.1fs %8.1fs %8.1fs  %s'
+              % (r['notebook'], r['status'], r['seconds'],
+                 r['kernel_startup'], r['kernel_wait'],
+                 describe_limits(r.get('kernel_limits', {}))))
+    waited = sum(r['kernel_wait'] for r in results)
+    print('Total time waiting for kernels: %.1fs' % waited)
+
+
+PROFILE_FIELDS = ['notebook', 'cell', 'execution_count', 'first_line',
+                  'source_hash',
+                  'wall_seconds', 'cpu_seconds', 'peak_rss_delta_bytes',
+                  'output_bytes']
+
+
+def cell_rows(results):
+    """Flatten the per-cell profiles of all notebooks into one list."""
+    return [dict(c, notebook=r['notebook'])
+            for r in results for c in r.get('cells', [])]
+
+
+def write_profile(results, stem):
+    """Write the profile to stem + '.json' (per notebook) and stem + '.csv'
+    (one row per cell)."""
+    with open(stem + '.json', mode='wt') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'notebooks': results}, f, indent=1)
+    with open(stem + '.csv', mode='wt', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PROFILE_FIELDS)
+        writer.writeheader()
+        for row in cell_rows(results):
+            writer.writerow({k: row.get(k) for k in PROFILE_FIELDS})
+    print('Profile written to %s.json and %s.csv' % (stem, stem))
+
+
+def print_slowest_cells(results, top):
+    rows = sorted(cell_rows(results), key=lambda c: c['wall_seconds'],
+                  reverse=True)[:top]
+    if not rows:
+        return
+    print('*****')
+    print('Slowest %d cells:' % len(rows))
+    print('%8s %8s %9s %9s  %-30s %5s  %s' % ('wall', 'cpu', 'rss', 'output',
+                                              'notebook', 'cell', 'source'))
+    for c in rows:
+        cpu = c['cpu_seconds']
+        rss = c['peak_rss_delta_bytes']
+        print('%7.2fs %8s %9s %9s  %-30s %5d  %s'
+              % (c['wall_seconds'],
+                 '-' if cpu is None else '%.2fs' % cpu,
+                 '-' if rss is None else '%.1fM' % (rss / 2**20),
+                 '%.1fK' % (c['output_bytes'] / 2**10),
+                 os.path.basename(c['notebook'])[:30], c['cell'],
+                 c['first_line']))
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {'notebooks': {}, 'cells': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def timed_results(results):
+    """The results whose timings are comparable: notebooks that were run
+    from the top, rather than restored from the cache or a checkpoint."""
+    return [r for r in results
+            if r['status'] == 'ok' and not r.get('cells_restored')]
+
+
+def update_baseline(path, results):
+    """Store this run's notebook and cell times in the baseline at path,
+    keeping the entries of notebooks that were not run this time."""
+    baseline = load_baseline(path)
+    for r in timed_results(results):
+        name = os.path.basename(r['notebook'])
+        baseline['notebooks'][name] = r['seconds'] - r['kernel_wait']
+        baseline['cells'][name] = {
+            str(c['cell']): {'source_hash': c['source_hash'],
+                             'wall_seconds': c['wall_seconds']}
+            for c in r.get('cells', [])}
+    with open(path, mode='wt') as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+    print('Baseline updated in %s' % path)
+
+
+def find_regressions(path, results, threshold, min_seconds):
+    """Compare this run against the baseline at path.
+
+    A notebook or cell counts as a regression when it took more than
+    threshold (a fraction) longer than its baseline time, and at least
+    min_seconds longer, so that jitter in very short cells is ignored.
+    Notebook totals are compared for notebooks run from the top, and cells
+    for every cell that executed.  A cell is matched on its source, or
+    failing that on its position, so an edited cell is compared with the
+    version it replaced.
+    """
+    baseline = load_baseline(path)
+    regressions = []
+
+    def check(what, before, after):
+        if after - before >= min_seconds and after > before * (1 + threshold):
+            regressions.append((what, before, after))
+
+    timed = [r['notebook'] for r in timed_results(results)]
+    for r in results:
+        name = os.path.basename(r['notebook'])
+        if r['notebook'] in timed and name in baseline['notebooks']:
+            check(name, baseline['notebooks'][name],
+                  r['seconds'] - r['kernel_wait'])
+        cells = baseline['cells'].get(name, {})
+        by_hash = {}
+        for key, entry in cells.items():
+            if isinstance(entry, dict):
+                by_hash[entry['source_hash']] = entry['wall_seconds']
+            else:
+                by_hash[key] = entry  # Baselines keyed on the source only
+        for c in r.get('cells', []):
+            what = '%s cell %d (%s)' % (name, c['cell'], c['first_line'])
+            entry = cells.get(str(c['cell']))
+            if c['source_hash'] in by_hash:
+                check(what, by_hash[c['source_hash']], c['wall_seconds'])
+            elif isinstance(entry, dict):
+                check(what + ', edited', entry['wall_seconds'],
+                      c['wall_seconds'])
+    return regressions
+
+
+def print_regressions(regressions, threshold):
+    print('*****')
+    if not regressions:
+        print('No notebook or cell is more than %d%% slower than the baseline.'
+              % (threshold * 100))
+        return
+    print('%d regressions against the baseline:' % len(regressions))
+    for what, before, after in regressions:
+        print('%8.2fs -> %8.2fs (%+.0f%%)  %s'
+              % (before, after, 100 * (after / before - 1) if before else 0,
+                 what))
+
+
+def write_json(path, obj):
+    """Write obj as JSON to path atomically, so readers on other machines
+    never see a partial file."""
+    tmp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp, mode='wt') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, path)
+
+
+def read_json_dir(path):
+    """Read every *.json file in path, keyed on the name without '.json'."""
+    found = {}
+    for name in os.listdir(path):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(path, name)) as f:
+                    found[name[:-5]] = json.load(f)
+            except (OSError, ValueError):
+                pass  # Moved or still being renamed into place
+    return found
+
+
+# A work queue is a directory on a filesystem shared by all build nodes:
+#   todo/<job>.json       notebooks waiting for a worker, taken in name order
+#   claimed/<job>.<worker>.json
+#                         notebooks being run; a worker claims one by renaming
+#                         it out of todo/, which only one rename can win
+#   done/<job>.json       the result record of each finished notebook
+#   closed                created by the coordinator once everything is done
+QUEUE_DIRS = ('todo', 'claimed', 'done')
+
+
+def worker_name():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def enqueue(queue, notebooks, run_path):
+    """Start a new run in queue with notebooks, in the order given."""
+    for d in QUEUE_DIRS:
+        os.makedirs(os.path.join(queue, d), exist_ok=True)
+    for d in ('todo', 'done'):
+        for name in os.listdir(os.path.join(queue, d)):
+            os.remove(os.path.join(queue, d, name))
+    if os.path.exists(os.path.join(queue, 'closed')):
+        os.remove(os.path.join(queue, 'closed'))
+    jobs = {}
+    for rank, n in enumerate(notebooks):
+        job = '%04d-%s' % (rank, os.path.basename(n).replace('.', '_'))
+        jobs[job] = n
+        write_json(os.path.join(queue, 'todo', job + '.json'),
+                   {'job': job, 'name': n, 'notebook': os.path.abspath(n),
+                    'run_path': os.path.abspath(run_path)})
+    return jobs
+
+
+def claim(queue):
+    """Take the first job from todo/ and return (claimed path, job), or
+    (None, None) if there is nothing to do."""
+    todo = os.path.join(queue, 'todo')
+    for name in sorted(os.listdir(todo)):
+        if not name.endswith('.json'):
+            continue
+        claimed = os.path.join(queue, 'claimed', '%s.%s.json'
+                               % (name[:-5], worker_name()))
+        try:
+            os.rename(os.path.join(todo, name), claimed)
+        except FileNotFoundError:
+            continue  # Another worker got there first
+        with open(claimed) as f:
+            return claimed, json.load(f)
+    return None, None
+
+
+def heartbeat(path, interval):
+    """Touch path every interval seconds until the returned event is set, so
+    the coordinator can tell a live claim from one whose worker died."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                os.utime(path)
+            except OSError:
+                return
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+
+def queue_closed(queue, since):
+    """Whether the coordinator has closed the queue since the given time; an
+    older closed file is left over from the previous run."""
+    try:
+        return os.path.getmtime(os.path.join(queue, 'closed')) >= since
+    except OSError:
+        return False
+
+
+def work(args, counter=None, count=1, since=None):
+    """Run notebooks from the queue until the coordinator closes it, at or
+    after since (default now)."""
+    queue = args.queue
+    started = since or time.time()
+    init_worker(args, counter, count)
+    print('Worker %s waiting for notebooks in %s' % (worker_name(), queue))
+    try:
+        while not queue_closed(queue, started):
+            if not os.path.isdir(os.path.join(queue, 'todo')):
+                time.sleep(args.poll)
+                continue
+            claimed, job = claim(queue)
+            if job is None:
+                time.sleep(args.poll)
+                continue
+            print('Running', job['notebook'])
+            job_args = argparse.Namespace(**vars(args))
+            job_args.run_path = job['run_path']
+            # The coordinator keeps the manifest, under the names it was given
+            job_args.manifest = None
+            stop = heartbeat(claimed, max(args.stale_after / 4, 1))
+            try:
+                result = run_notebook(job['notebook'], job_args)
+            except Exception as e:
+                result = failed_result(job['notebook'], e)
+            finally:
+                stop.set()
+            result.update(notebook=job['name'], worker=worker_name())
+            write_json(os.path.join(queue, 'done', job['job'] + '.json'),
+                       result)
+            os.remove(claimed)
+    finally:
+        kernel_pool.shutdown()
+
+
+def coordinate(notebooks, args):
+    """Queue notebooks for the workers and collect their results.
+
+    Claims whose worker has not touched them for args.stale_after seconds
+    are put back in todo/ for another worker.  With args.local_workers, that
+    many worker processes are started here too, which is also how to try
+    the queue out on one machine.
+    """
+    queue = args.queue
+    # Local workers may start after a short run has already closed the queue
+    started = time.time()
+    jobs = enqueue(queue, notebooks, args.run_path)
+    counter = multiprocessing.Value('i', 0)
+    local = [multiprocessing.Process(target=work,
+                                     args=(args, counter, args.local_workers,
+                                           started))
+             for _ in range(args.local_workers)]
+    for p in local:
+        p.start()
+    results = {}
+    try:
+        while len(results) < len(jobs):
+            for job, r in read_json_dir(os.path.join(queue, 'done')).items():
+                if job in jobs and job not in results:
+                    results[job] = r
+                    mark_notebook(args, jobs[job], 'done' if r['status'] in
+                                  ('ok', 'cached') else 'failed',
+                                  r.get('hash'), r['status'])
+                    print('Finished', r['notebook'], ':', len(results), '/',
+                          len(jobs), '(%s, %.1fs on %s)'
+                          % (r['status'], r['seconds'], r.get('worker')))
+            claimed_dir = os.path.join(queue, 'claimed')
+            for name in os.listdir(claimed_dir):
+                path = os.path.join(claimed_dir, name)
+                job = name.split('.')[0]
+                try:
+                    stale = time.time() - os.path.getmtime(path) > args.stale_after
+                except OSError:
+                    continue
+                if stale and job in jobs and job not in results:
+                    print('Requeueing %s from %s' % (jobs[job], name))
+                    try:
+                        os.rename(path, os.path.join(queue, 'todo', job + '.json'))
+                    except OSError:
+                        pass
+            if len(results) < len(jobs):
+                time.sleep(args.poll)
+    finally:
+        open(os.path.join(queue, 'closed'), 'w').close()
+        for p in local:
+            p.join()
+    return list(results.values())
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_history(path, results):
+    """Record how long each notebook took when it ran from the top."""
+    history = load_history(path)
+    for r in timed_results(results):
+        history[os.path.basename(r['notebook'])] = r['seconds']
+    with open(path, mode='wt') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+
+def predict_durations(notebooks, args, history):
+    """Expected seconds for each notebook: 0 if it is in the cache, else its
+    last recorded duration.  Notebooks with no history are assumed to be as
+    slow as the slowest known one, so they are not left until the end."""
+    default = max(history.values(), default=0.0)
+    predicted = {}
+    for n in notebooks:
+        nb = read_notebook(n + '.ipynb', args)
+        key = notebook_hash(nb, args.data_dir)
+        if args.cache_dir and (
+                os.path.exists(os.path.join(args.cache_dir, key + '.ipynb'))
+                or book_cache_record(nb, key, args) is not None):
+            predicted[n] = 0.0
+        else:
+            predicted[n] = history.get(os.path.basename(n), default)
+    return predicted
+
+
+def predict_makespan(durations, workers):
+    """Makespan of running durations, in the given order, on workers slots
+    that each take the next job as soon as they are free."""
+    slots = [0.0] * max(workers, 1)
+    for d in durations:
+        heapq.heappush(slots, heapq.heappop(slots) + d)
+    return max(slots)
+
+
+if __name__ == '__main__':
+    # Parse args
+    parser = argparse.ArgumentParser(description="Runs a set of Jupyter \
+                                                  notebooks.")
+    file_text = """ Notebook file(s) to be run, e.g. '*.ipynb' (default),
+    'my_nb1.ipynb', 'my_nb1.ipynb my_nb2.ipynb', 'my_dir/*.ipynb'
+    """
+    parser.add_argument('file_list', metavar='F', type=str, nargs='*',
+        help=file_text)
+    parser.add_argument('-t', '--timeout', help='Length of time (in secs) a cell \
+        can run before raising TimeoutError (default 600).', default=600,
+        required=False)
+    parser.add_argument('-p', '--run-path', help='The path the notebook will be \
+        run from (default pwd).', default='.', required=False)
+    parser.add_argument('-j', '--jobs', help='Number of notebooks to run at \
+        once, each in its own worker process and kernel (default 1, i.e. \
+        serial).', type=int, default=1, required=False)
+    parser.add_argument('-c', '--cache-dir', help='Directory of executed \
+        notebooks keyed on a hash of their code cells, kernel and data files. \
+        Unchanged notebooks are restored from here instead of being run \
+        (default .nbcache).', default=CACHE_DIR, required=False)
+    parser.add_argument('--no-cache', help='Run every notebook, and do not \
+        update the cache.', dest='cache_dir', action='store_const',
+        const=None)
+    parser.add_argument('--book-cache', help='jupyter-cache directory the \
+        book build reads with execute_notebooks: cache. Every notebook run \
+        or restored here is stored in it, so jupyter-book does not execute \
+        it again (default Book/_build/.jupyter_cache).', default=BOOK_CACHE,
+        required=False)
+    parser.add_argument('--no-book-cache', help='Leave the book cache alone.',
+        dest='book_cache', action='store_const', const=None)
+    parser.add_argument('-d', '--data-dir', help='Directory of the data files \
+        the notebooks read. Cells that load them from the book\'s GitHub \
+        repository read them from here instead (default the Data folder next \
+        to this script).',
+        default=DATA_DIR, required=False)
+    parser.add_argument('--checkpoint-every', help='Save the kernel namespace \
+        after every Nth code cell, and after every cell that calls glue, so a \
+        notebook whose later cells changed can resume from the last unchanged \
+        checkpoint. Checkpoints stop at the first cell that sets a plot \
+        style, random seed, display option or the working directory, which \
+        a checkpoint cannot hold. 0 always runs notebooks from the top \
+        (default 10).',
+        type=int, default=10, required=False)
+    parser.add_argument('-w', '--warm-kernels', help='Number of kernels each \
+        worker keeps started, with numpy, pandas, seaborn, scipy.stats, \
+        pingouin and statsmodels already imported. Each kernel runs one \
+        notebook and is replaced in the background. The warnings those \
+        libraries print when imported then do not appear in the notebooks\' \
+        outputs. 0 starts a cold kernel for each notebook (default 0 for a \
+        serial run, so that it gives the same outputs as before, and 1 \
+        otherwise).', type=int, default=None, required=False)
+    parser.add_argument('--profile', help='Record wall time, CPU time, peak \
+        RSS growth and output size of every executed cell, and write them to \
+        PROFILE.json and PROFILE.csv (default notebook_profile).', nargs='?',
+        const='notebook_profile', default=None, metavar='PROFILE')
+    parser.add_argument('--top', help='Number of slowest cells to list after \
+        a profiled run (default 10).', type=int, default=10, required=False)
+    parser.add_argument('-b', '--baseline', help='JSON file of notebook and \
+        cell times to compare this run against. Exits with status 1 if \
+        anything got slower than --threshold allows. Implies cell \
+        profiling, --checkpoint-every 0 and, unless --update-baseline is \
+        given, --no-cache, so that every notebook runs from the top and is \
+        checked.', default=None, required=False)
+    parser.add_argument('--update-baseline', help='Store the times of this \
+        run in the --baseline file instead of comparing against it.',
+        action='store_true')
+    parser.add_argument('--threshold', help='Fraction by which a notebook or \
+        cell may be slower than its baseline (default 0.25).', type=float,
+        default=0.25, required=False)
+    parser.add_argument('--min-seconds', help='Slowdowns smaller than this \
+        many seconds are never regressions (default 1.0).', type=float,
+        default=1.0, required=False)
+    parser.add_argument('-a', '--async-jobs', help='Run notebooks on a single \
+        event loop in this process instead of in worker processes, with at \
+        most this many executing at once. Kernels are started cold; \
+        --warm-kernels only applies to --jobs.', type=int, default=0,
+        required=False)
+    parser.add_argument('-x', '--external-outputs', help='Write figures and \
+        other large outputs to this content-addressed directory, once per \
+        distinct payload, and keep only references to them in _out.ipynb \
+        and cached notebooks (default: keep outputs inline). At the end of \
+        the run, files that no _out.ipynb next to the notebooks run and no \
+        notebook in .nbcache, --cache-dir or --book-cache refers to are \
+        removed, so share it only \
+        between notebooks run from the same directories.', default=None,
+        required=False)
+    parser.add_argument('--external-min-bytes', help='Outputs smaller than \
+        this stay inline (default 4096).', type=int, default=4096,
+        required=False)
+    parser.add_argument('-m', '--manifest', help='JSON file recording the \
+        state (pending, running, done, failed) and input hash of every \
+        notebook in the run (default run_manifest.json).',
+        default='run_manifest.json', required=False)
+    parser.add_argument('-r', '--resume', help='Only run the notebooks that \
+        the manifest does not list as done with their current inputs.',
+        action='store_true')
+    parser.add_argument('-f', '--fast-io', help='Read notebooks with orjson \
+        (if installed) and write them without validating them first. The \
+        files written are the same.', action='store_true')
+    parser.add_argument('--validate', help='With --fast-io, validate the \
+        _out.ipynb files once at the end of the run, and exit with status 1 \
+        if any is invalid.', action='store_true')
+    parser.add_argument('--kernel-memory', help='Cap on the address space of \
+        each kernel, e.g. 4G. A cell that goes over it fails with \
+        MemoryError (Linux only).', default=None, required=False)
+    parser.add_argument('--cpu-affinity', help="CPUs each kernel may run on, \
+        e.g. '0-3,8', or 'auto' to give each worker its own equal share of \
+        this machine's CPUs (Linux only).", default=None, required=False)
+    parser.add_argument('--kernel-threads', help='Number of BLAS/OpenMP \
+        threads per kernel (default: the number of CPUs it is pinned to, or \
+        the libraries\' own default).', type=int, default=None,
+        required=False)
+    parser.add_argument('-e', '--events', help="Stream JSON-lines events \
+        for notebook and cell starts and ends, errors and timeouts to this \
+        file, or to a Unix socket given as 'unix:PATH'. Follow them with \
+        tail_events.py.", default=None, required=False)
+    parser.add_argument('--history', help='JSON file of how long each notebook \
+        last took. When running more than one notebook at a time, the \
+        notebooks expected to take longest are started first (default \
+        notebook_durations.json).', default='notebook_durations.json',
+        required=False)
+    parser.add_argument('-q', '--queue', help='Shared directory to use as a \
+        work queue between build nodes. Without --work, queue the notebooks \
+        there and wait for workers to run them.', default=None, required=False)
+    parser.add_argument('--work', help='Act as a worker: run notebooks from \
+        --queue until the coordinator closes it.', action='store_true')
+    parser.add_argument('--local-workers', help='Number of worker processes \
+        the coordinator starts on this machine (default 0).', type=int,
+        default=0, required=False)
+    parser.add_argument('--poll', help='Seconds between checks of the queue \
+        (default 2).', type=float, default=2, required=False)
+    parser.add_argument('--stale-after', help='Seconds after which a claimed \
+        notebook whose worker has stopped responding is queued again \
+        (default 300).', type=float, default=300, required=False)
+    args = parser.parse_args()
+    if args.warm_kernels is None:
+        args.warm_kernels = 0 if args.jobs <= 1 and not args.queue else 1
+    if args.baseline:
+        # Notebook times are only comparable when run from the top
+        args.checkpoint_every = 0
+        if not args.update_baseline:
+            # and a notebook restored from the cache is not timed at all
+            args.cache_dir = None
+    print('Args:', args)
+    if args.book_cache and jupyter_cache is None:
+        print('jupyter-cache is not installed: not using the book cache.')
+    elif args.book_cache and CacheBundleIn is None:
+        parser.error('jupyter-cache %s has neither CacheBundleIn nor '
+                     'NbBundleIn; install a version this script supports, or '
+                     'use --no-book-cache.'
+                     % getattr(jupyter_cache, '__version__', '?'))
+    if args.work:
+        if not args.queue:
+            parser.error('--work needs --queue')
+        work(args)
+        sys.exit(0)
+    if not args.file_list: # Default file_list
+        args.file_list = glob.glob('*.ipynb')
+
+    # Check list of notebooks
+    notebooks = []
+    print('Notebooks to run:')
+    for f in args.file_list:
+        # Find notebooks but not notebooks previously output from this script
+        if f.endswith('.ipynb') and not f.endswith('_out.ipynb'):
+            print(f[:-6])
+            notebooks.append(f[:-6]) # Want the filename without '.ipynb'
+
+    if args.resume:
+        manifest = load_manifest(args.manifest)
+        done = [n for n in notebooks if up_to_date(n, manifest.get(n, {}), args)]
+        if done:
+            print('Resuming: %d notebooks are already done.' % len(done))
+            notebooks = [n for n in notebooks if n not in done]
+    if args.manifest:
+        update_manifest(args.manifest,
+                        {n: {'state': 'pending'} for n in notebooks})
+
+    # Longest processing time first: with several workers, starting the
+    # slowest notebooks first keeps them from finishing long after the rest
+    workers = args.async_jobs or args.jobs
+    if args.queue:
+        workers = max(workers, args.local_workers)
+    history = load_history(args.history)
+    if workers > 1 or args.queue:
+        predicted = predict_durations(notebooks, args, history)
+        given_order = list(notebooks)
+        notebooks.sort(key=lambda n: predicted[n], reverse=True)
+        print('*****')
+        print('Predicted makespan: %.1fs in this order, %.1fs in the given '
+              'order.' % (predict_makespan([predicted[n] for n in notebooks],
+                                            workers),
+                          predict_makespan([predicted[n] for n in given_order],
+                                           workers)))
+
+    # Execute notebooks and output
+    num_notebooks = len(notebooks)
+    print('*****')
+    results = []
+    run_start = time.perf_counter()
+    open_events(args)
+    events.emit('run_start', notebooks=num_notebooks)
+    if args.queue:
+        results = coordinate(notebooks, args)
+        results.sort(key=lambda r: notebooks.index(r['notebook']))
+    elif args.async_jobs > 0:
+        results = asyncio.run(run_all_async(notebooks, args))
+        results.sort(key=lambda r: notebooks.index(r['notebook']))
+    elif args.jobs <= 1:
+        init_worker(args)
+        try:
+            for i, n in enumerate(notebooks):
+                print('Running', n, ':', i, '/', num_notebooks)
+                results.append(run_notebook(n, args))
         finally:
-            # Write output file
-            with open(n_out + '.ipynb', mode='wt') as f:
-                nbformat.write(nb, f)
-                
\ No newline at end of file
+            kernel_pool.shutdown()
+    else:
+        # Each worker process has its own kernels, and writes its _out.ipynb
+        # as soon as its notebook finishes
+        counter = multiprocessing.Value('i', 0)
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                                 initargs=(args, counter, args.jobs)) as pool:
+            futures = {pool.submit(run_notebook, n, args): n
+                       for n in notebooks}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    r = future.result()
+                except Exception as e:
+                    # e.g. the worker process died: still report the rest
+                    r = failed_result(futures[future], e)
+                print('Finished', r['notebook'], ':', i + 1, '/', num_notebooks,
+                      '(%s, %.1fs)' % (r['status'], r['seconds']))
+                results.append(r)
+        # Report in the order the notebooks were given
+        results.sort(key=lambda r: notebooks.index(r['notebook']))
+    print_report(results)
+    makespan = time.perf_counter() - run_start
+    events.emit('run_end', notebooks=num_notebooks, seconds=makespan,
+                failed=sum(r['status'] in ('error', 'timeout', 'killed')
+                           for r in results))
+    if workers > 1 or args.queue:
+        print('Actual makespan: %.1fs (predicted %.1fs).'
+              % (makespan, predict_makespan(
+                  [predicted[n] for n in notebooks], workers)))
+    else:
+        print('Total run time: %.1fs.' % makespan)
+    update_history(args.history, results)
+    if args.external_outputs and os.path.isdir(args.external_outputs):
+        live = set()
+        for d in set(os.path.dirname(os.path.abspath(n)) for n in notebooks):
+            live.update(glob.glob(os.path.join(d, '*_out.ipynb')))
+        # The caches count even when this run did not use them
+        for d in set(filter(None, (args.cache_dir, CACHE_DIR))):
+            live.update(glob.glob(os.path.join(d, '*.ipynb')))
+        if args.book_cache:
+            live.update(glob.glob(os.path.join(args.book_cache, '**',
+                                               '*.ipynb'), recursive=True))
+        removed, size = sweep_external_outputs(args.external_outputs, live)
+        if removed:
+            print('Removed %d unused outputs (%.1f MB) from %s'
+                  % (removed, size / 1e6, args.external_outputs))
+    # Every report is written before a failed check sets the exit status
+    failed = False
+    if args.fast_io and args.validate:
+        if validate_outputs([r['notebook'] + '_out.ipynb' for r in results]):
+            failed = True
+    if args.profile:
+        print_slowest_cells(results, args.top)
+        write_profile(results, args.profile)
+    if args.baseline:
+        if args.update_baseline:
+            update_baseline(args.baseline, results)
+        else:
+            regressions = find_regressions(args.baseline, results,
+                                           args.threshold, args.min_seconds)
+            print_regressions(regressions, args.threshold)
+            if regressions:
+                failed = True
+    if failed:
+        sys.exit(1)
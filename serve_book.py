@@ -0,0 +1,231 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import email.utils
+import hashlib
+import re
+import threading
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HTML_DIR = os.path.join(HERE, 'Book', '_build', 'html')
+# Content-Encoding of each precompressed variant written by compress_site.py,
+# in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Pages and the search index change with every build, so browsers must
+# check them; everything else may be reused for max_age seconds
+REVALIDATE = ('.html', 'searchindex.js')
+# Bundles written by bundle_assets.py are named by their contents, so they
+# never change
+FINGERPRINTED_RE = re.compile(r'\.[0-9a-f]{16}\.(?:css|js)$')
+
+
+class ETags:
+    """Strong ETags from the sha256 of each file, recomputed only when the
+    file's size or modification time changes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tags = {}
+
+    def get(self, path, st):
+        stamp = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            cached = self.tags.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        tag = '"%s"' % h.hexdigest()[:32]
+        with self.lock:
+            self.tags[path] = (stamp, tag)
+        return tag
+
+
+def accepted_encodings(header):
+    """Content codings the client accepts, from Accept-Encoding."""
+    accepted = set()
+    for part in (header or '').split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def parse_range(header, size):
+    """(start, end) inclusive for a single 'bytes=' range, None to send the
+    whole file, or False if the range cannot be satisfied."""
+    m = RANGE_RE.match(header.strip()) if header else None
+    if not m or m.groups() == ('', ''):
+        return None  # Unsupported forms, like several ranges, get it all
+    first, last = m.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+class BookRequestHandler(SimpleHTTPRequestHandler):
+    """Serves the built book with precompressed variants, strong ETags,
+    Cache-Control and single byte ranges."""
+
+    protocol_version = 'HTTP/1.1'
+    max_age = 3600
+    etags = ETags()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split('?', 1)[0].endswith('/'):
+                # Let the standard handler redirect to the trailing slash
+                return super().send_head()
+            path = os.path.join(path, 'index.html')
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+
+        # Use a precompressed variant if it is at least as new as the file
+        served, encoding = path, None
+        accepted = accepted_encodings(self.headers.get('Accept-Encoding'))
+        for coding, suffix in ENCODINGS:
+            if coding in accepted:
+                try:
+                    vst = os.stat(path + suffix)
+                except OSError:
+                    continue
+                if vst.st_mtime >= st.st_mtime:
+                    served, encoding, st = path + suffix, coding, vst
+                    break
+
+        etag = self.etags.get(served, st)
+        headers = [('Content-Type', self.guess_type(path)),
+                   ('ETag', etag),
+                   ('Last-Modified', self.date_time_string(st.st_mtime)),
+                   ('Cache-Control', self.cache_control(path)),
+                   ('Vary', 'Accept-Encoding'),
+                   ('Accept-Ranges', 'bytes')]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+
+        if self.not_modified(etag, st):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            for name, value in headers:
+                if name != 'Content-Type':
+                    self.send_header(name, value)
+            self.end_headers()
+            return None
+
+        size = st.st_size
+        byte_range = None
+        if_range = self.headers.get('If-Range')
+        if if_range is None or if_range == etag:
+            byte_range = parse_range(self.headers.get('Range'), size)
+        if byte_range is False:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        f = open(served, 'rb')
+        if byte_range is None:
+            start, length = 0, size
+            self.send_response(HTTPStatus.OK)
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        f.seek(start)
+        self.remaining = length
+        return f
+
+    def copyfile(self, source, outputfile):
+        """Send only the selected range of source."""
+        remaining = self.remaining
+        while remaining > 0:
+            block = source.read(min(remaining, 1 << 16))
+            if not block:
+                break
+            outputfile.write(block)
+            remaining -= len(block)
+
+    def cache_control(self, path):
+        if path.endswith(REVALIDATE):
+            return 'no-cache'
+        if FINGERPRINTED_RE.search(path):
+            return 'public, max-age=31536000, immutable'
+        return 'public, max-age=%d' % self.max_age
+
+    def not_modified(self, etag, st):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            # Weak comparison, as RFC 9110 asks for If-None-Match
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(st.st_mtime) <= since.timestamp()
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves the built book \
+        over HTTP, sending the gzip or brotli versions written by \
+        compress_site.py to clients that accept them, with strong ETags, \
+        Cache-Control headers and byte ranges.")
+    parser.add_argument('root', nargs='?', default=HTML_DIR,
+        help='Built HTML directory (default Book/_build/html).')
+    parser.add_argument('-p', '--port', help='Port to listen on (default \
+        8000).', type=int, default=8000)
+    parser.add_argument('-b', '--bind', help='Address to listen on (default \
+        127.0.0.1; use 0.0.0.0 to serve the network).', default='127.0.0.1')
+    parser.add_argument('--max-age', help='Seconds browsers may reuse \
+        images, scripts and styles without asking again (default 3600). \
+        Pages and the search index are always revalidated.', type=int,
+        default=3600)
+    args = parser.parse_args()
+
+    BookRequestHandler.max_age = args.max_age
+    handler = partial(BookRequestHandler, directory=args.root)
+    server = ThreadingHTTPServer((args.bind, args.port), handler)
+    print('Serving %s on http://%s:%d/' % (args.root, args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
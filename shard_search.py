@@ -0,0 +1,395 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import bisect
+import gzip
+import hashlib
+import json
+import re
+import time
+
+try:
+    import snowballstemmer
+except ImportError:
+    snowballstemmer = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HTML_DIR = os.path.join(HERE, 'Book', '_build', 'html')
+SHARD_DIR = '_search'
+SET_INDEX_RE = re.compile(r'^\s*Search\.setIndex\((.*)\)\s*;?\s*$', re.S)
+LOADER_INDEX_RE = re.compile(r'^  const index = (.*);$', re.M)
+SHARD_RE = re.compile(r'^SearchShards\.add\("[^"]*", (.*)\);$', re.S)
+STOPWORDS_RE = re.compile(r'var\s+stopwords\s*=\s*(\[[^\]]*\])')
+# The script tag of search.html that loads the index: Sphinx's own, or the
+# loader written by an earlier run
+INDEX_TAG_RE = re.compile(r'<script\b[^>]*\bsrc="searchindex\.js"[^>]*>\s*</script>'
+                          r'|<script id="search-shards">.*?</script>', re.S)
+QUERIES = ['t-test', 'anova', 'chi-square', 'regression',
+           'standard deviation', 'p value', 'bayes factor', 'pandas dataframe']
+
+# Replaces searchindex.js on the search page, inline so that it costs no
+# request of its own.  It holds everything but the full-text terms, which
+# are split into shards by prefix and loaded when a query needs them, as
+# scripts so that the book still works from file://.  Search.query is wrapped so that it only runs once the shards for
+# its words are in.  Sphinx also matches words of more than two letters
+# inside longer terms; with shards, those matches are limited to the terms
+# of the shards loaded for the query, which hold every term starting with
+# the word.
+LOADER = '''\
+(() => {
+  const base = new URL(%(dir)s, document.baseURI);
+  const index = %(index)s;
+  const shards = %(shards)s;
+  const firsts = shards.map((shard) => shard[0]);
+  const loaded = {};
+  const loading = {};
+
+  window.SearchShards = { add: (file, terms) => (loaded[file] = terms) };
+
+  const load = (file) =>
+    (loading[file] ??= new Promise((resolve, reject) => {
+      const script = document.createElement("script");
+      script.src = new URL(file, base).href;
+      script.onload = () => resolve(loaded[file]);
+      script.onerror = reject;
+      document.body.appendChild(script);
+    }));
+
+  // The shard whose range holds word, and for a partial match the ones
+  // after it whose terms start with word
+  const shardsFor = (word) => {
+    let lo = 0;
+    let hi = firsts.length;
+    while (lo < hi) {
+      const mid = (lo + hi) >> 1;
+      if (firsts[mid] <= word) lo = mid + 1;
+      else hi = mid;
+    }
+    const found = [shards[Math.max(lo - 1, 0)][1]];
+    if (word.length > 2)
+      for (let i = lo; i < firsts.length && firsts[i].startsWith(word); i++)
+        found.push(shards[i][1]);
+    return found;
+  };
+
+  // The words Search.query looks up, found the same way
+  const queryWords = (query) => {
+    const stemmer = new Stemmer();
+    const words = new Set();
+    splitQuery(query.trim()).forEach((queryTerm) => {
+      const queryTermLower = queryTerm.toLowerCase();
+      if (stopwords.indexOf(queryTermLower) !== -1 || queryTerm.match(/^\\d+$/))
+        return;
+      const word = stemmer.stemWord(queryTermLower);
+      words.add(word[0] === "-" ? word.substr(1) : word);
+    });
+    return words;
+  };
+
+  const query = Search.query;
+  Search.query = (text) => {
+    const files = new Set();
+    queryWords(text).forEach((word) =>
+      shardsFor(word).forEach((file) => files.add(file))
+    );
+    Promise.all([...files].map(load)).then(
+      (parts) => {
+        index.terms = Object.assign({}, ...parts);
+        query(text);
+      },
+      () => {
+        Search.stopPulse();
+        Search.title.innerText = _("Search Error");
+        Search.status.innerText = _("The search index could not be loaded.");
+      }
+    );
+  };
+  Search.setIndex(index);
+})();
+'''
+SHARD = 'SearchShards.add(%s, %s);\n'
+
+
+def dump(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                      sort_keys=True)
+
+
+def utf16_key(term):
+    # Browsers compare strings by UTF-16 code units
+    return term.encode('utf-16-be')
+
+
+def read_index(path):
+    with open(path, encoding='utf-8') as f:
+        m = SET_INDEX_RE.match(f.read())
+    if not m:
+        raise ValueError('%s is not a Sphinx search index' % path)
+    return json.loads(m.group(1))
+
+
+def split_terms(terms, shard_bytes):
+    """Split the terms, in order, into shards of about shard_bytes each,
+    never splitting the terms that share a three letter prefix.  Returns a
+    list of (first term, {term: documents})."""
+    shards = []
+    current = {}
+    size = 0
+    prefix = None
+    for term in sorted(terms, key=utf16_key):
+        entry = len(dump({term: terms[term]}).encode('utf-8'))
+        if current and size + entry > shard_bytes and term[:3] != prefix:
+            shards.append(current)
+            current = {}
+            size = 0
+        current[term] = terms[term]
+        size += entry
+        prefix = term[:3]
+    if current or not shards:
+        shards.append(current)
+    return [(next(iter(shard), ''), shard) for shard in shards]
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def write_atomic(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def write_shards(html_dir, index, shard_bytes):
+    """Write the shards, named by their contents, and remove the ones an
+    earlier run left.  Returns the loader, holding the rest of the index,
+    and [(first term, shard path under html_dir)]."""
+    out_dir = os.path.join(html_dir, SHARD_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = []
+    written = set()
+    for first, terms in split_terms(index['terms'], shard_bytes):
+        body = dump(terms)
+        name = 'terms.%s.js' % fingerprint(body.encode('utf-8'))
+        path = os.path.join(out_dir, name)
+        if not os.path.exists(path):
+            write_atomic(path, (SHARD % (json.dumps(name), body)).encode('utf-8'))
+        manifest.append((first, name))
+        written.add(name)
+    for old in os.listdir(out_dir):
+        if old not in written:
+            os.remove(os.path.join(out_dir, old))
+    loader = LOADER % {'dir': json.dumps(SHARD_DIR + '/'),
+                       'index': dump(dict(index, terms={})),
+                       'shards': dump([list(s) for s in manifest])}
+    # Nothing in the page may end the script early
+    loader = loader.replace('</', '<\\/')
+    return loader, [(first, os.path.join(SHARD_DIR, file))
+                    for first, file in manifest]
+
+
+def point_search_page(html_dir, loader):
+    """Put the loader in search.html in place of searchindex.js.  Returns
+    False if the page has no index tag."""
+    page = os.path.join(html_dir, 'search.html')
+    with open(page, encoding='utf-8') as f:
+        html = f.read()
+    tag = '<script id="search-shards">\n%s</script>' % loader
+    new, n = INDEX_TAG_RE.subn(lambda m: tag, html, count=1)
+    if not n:
+        return False
+    if new != html:
+        write_atomic(page, new.encode('utf-8'))
+    return True
+
+
+# Offline benchmark.  It follows the steps a browser takes for a query with
+# an empty cache once the search page is in: fetch and parse the whole of
+# searchindex.js, or parse the loader, which makes the page that much
+# bigger, and fetch the shards for the query's words together.  Network time is
+# modelled from the gzip size of each file, a round trip time and a
+# bandwidth; parsing and matching are timed here.
+
+def make_stemmer():
+    if snowballstemmer is None:
+        return lambda word: word
+    # Sphinx stems English with the Porter stemmer, in Python and in JS
+    return snowballstemmer.stemmer('porter').stemWord
+
+
+def read_stopwords(html_dir):
+    try:
+        with open(os.path.join(html_dir, '_static', 'language_data.js'),
+                  encoding='utf-8') as f:
+            m = STOPWORDS_RE.search(f.read())
+    except OSError:
+        return set()
+    return set(json.loads(m.group(1))) if m else set()
+
+
+def query_words(query, stopwords, stem):
+    words = []
+    for term in re.split(r'[^\w]+', query.strip()):
+        lower = term.lower()
+        if term and lower not in stopwords and not term.isdigit():
+            word = stem(lower)
+            if word not in words:
+                words.append(word)
+    return words
+
+
+def as_list(docs):
+    return docs if isinstance(docs, list) else [docs]
+
+
+def matching_docs(words, terms, titleterms):
+    """Documents holding every word, as searchtools.js finds them: exact
+    terms and title terms, or else terms containing the word."""
+    found = None
+    for word in words:
+        docs = set(as_list(terms.get(word, [])))
+        docs.update(as_list(titleterms.get(word, [])))
+        if len(word) > 2 and word not in terms:
+            for term, term_docs in terms.items():
+                if word in term:
+                    docs.update(as_list(term_docs))
+        found = docs if found is None else found & docs
+    return found or set()
+
+
+def shards_for(word, firsts, files):
+    i = bisect.bisect_right([utf16_key(f) for f in firsts], utf16_key(word))
+    found = [files[max(i - 1, 0)]]
+    if len(word) > 2:
+        while i < len(firsts) and firsts[i].startswith(word):
+            found.append(files[i])
+            i += 1
+    return found
+
+
+class Transfer:
+    """Size of each file as sent, and the time to parse it."""
+
+    def __init__(self, html_dir):
+        self.html_dir = html_dir
+        self.files = {}
+
+    def get(self, path, pattern=SHARD_RE):
+        if path not in self.files:
+            with open(os.path.join(self.html_dir, path), 'rb') as f:
+                self.files[path] = self.measure(f.read(), pattern)
+        return self.files[path]
+
+    @staticmethod
+    def measure(data, pattern):
+        """(bytes, gzipped bytes, seconds to parse, parsed index)."""
+        start = time.perf_counter()
+        payload = json.loads(pattern.search(data.decode('utf-8')).group(1))
+        parse = time.perf_counter() - start
+        return len(data), len(gzip.compress(data, 9, mtime=0)), parse, payload
+
+
+def fetch_time(sizes, rtt, bandwidth):
+    """Seconds to fetch files requested together, sharing the bandwidth."""
+    return rtt + sum(sizes) * 8 / bandwidth if sizes else 0.0
+
+
+def benchmark(html_dir, loader, manifest, queries, rtt, bandwidth):
+    stem = make_stemmer()
+    stopwords = read_stopwords(html_dir)
+    transfer = Transfer(html_dir)
+    full_raw, full_gz, full_parse, full = transfer.get('searchindex.js',
+                                                       SET_INDEX_RE)
+    base_raw, base_gz, base_parse, _ = transfer.measure(loader.encode('utf-8'),
+                                                        LOADER_INDEX_RE)
+    firsts = [first for first, _ in manifest]
+    files = [path for _, path in manifest]
+    bandwidth = bandwidth * 1e6
+
+    print('*****')
+    print('searchindex.js: %.1f KB (%.1f KB gzipped); loader %.1f KB (%.1f KB '
+          'gzipped) and %d shards of %.1f KB on average'
+          % (full_raw / 1e3, full_gz / 1e3, base_raw / 1e3, base_gz / 1e3,
+             len(files), sum(transfer.get(p)[0] for p in files) / len(files) / 1e3))
+    print('Model: %d ms round trips, %.0f Mbit/s, empty cache; sizes are gzipped'
+          % (rtt * 1e3, bandwidth / 1e6))
+    if snowballstemmer is None:
+        print('snowballstemmer is not installed: query words are not stemmed.')
+    print('%-20s %6s %10s %10s %10s %10s %8s'
+          % ('query', 'shards', 'KB before', 'KB after', 'ms before',
+             'ms after', 'results'))
+
+    session = set()
+    session_bytes = 0
+    for query in queries:
+        words = query_words(query, stopwords, stem)
+        start = time.perf_counter()
+        expected = matching_docs(words, full['terms'], full['titleterms'])
+        search_time = time.perf_counter() - start
+        before = (fetch_time([full_gz], rtt, bandwidth) + full_parse
+                  + search_time)
+
+        needed = sorted({p for w in words for p in shards_for(w, firsts, files)})
+        shard_sizes = [transfer.get(p)[1] for p in needed]
+        terms = {}
+        for p in needed:
+            terms.update(transfer.get(p)[3])
+        start = time.perf_counter()
+        got = matching_docs(words, terms, full['titleterms'])
+        search_time = time.perf_counter() - start
+        after = (base_gz * 8 / bandwidth + base_parse
+                 + fetch_time(shard_sizes, rtt, bandwidth)
+                 + sum(transfer.get(p)[2] for p in needed)
+                 + search_time)
+        session_bytes += sum(transfer.get(p)[1] for p in needed if p not in session)
+        session.update(needed)
+
+        results = '%d' % len(got)
+        if got != expected:
+            results += ' (%d)' % len(expected)
+        print('%-20s %6d %10.1f %10.1f %10.1f %10.1f %8s'
+              % (query[:20], len(needed), full_gz / 1e3,
+                 (base_gz + sum(shard_sizes)) / 1e3, before * 1e3,
+                 after * 1e3, results))
+    print('All %d queries in one visit: %.1f KB before, %.1f KB after'
+          % (len(queries), full_gz / 1e3, (base_gz + session_bytes) / 1e3))
+    print('Results in brackets are those of the full index, where partial '
+          'matches differ.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Splits the search index \
+        of the built book into shards of terms by prefix, which the search \
+        page loads only when a query needs them, instead of downloading all \
+        of searchindex.js first. searchindex.js itself is left in place for \
+        incremental builds.")
+    parser.add_argument('root', nargs='?', default=HTML_DIR,
+        help='Built HTML directory (default Book/_build/html).')
+    parser.add_argument('--shard-bytes', help='Rough size of each shard \
+        before compression (default 8000).', type=int, default=8000)
+    parser.add_argument('--benchmark', help='Compare the bytes and modelled \
+        latency of typical queries with the full and the sharded index.',
+        action='store_true')
+    parser.add_argument('-q', '--query', help='Query to benchmark; may be \
+        repeated (default: a set of typical queries).', action='append',
+        dest='queries')
+    parser.add_argument('--rtt', help='Round trip time in ms for the \
+        benchmark (default 50).', type=float, default=50)
+    parser.add_argument('--bandwidth', help='Bandwidth in Mbit/s for the \
+        benchmark (default 10).', type=float, default=10)
+    args = parser.parse_args()
+
+    index = read_index(os.path.join(args.root, 'searchindex.js'))
+    loader, manifest = write_shards(args.root, index, args.shard_bytes)
+    print('Split %d terms into %d shards under %s'
+          % (len(index['terms']), len(manifest),
+             os.path.join(args.root, SHARD_DIR)))
+    if not point_search_page(args.root, loader):
+        print('search.html does not load searchindex.js by itself (was it '
+              'bundled?): left as it is.')
+    if args.benchmark:
+        benchmark(args.root, loader, manifest, args.queries or QUERIES,
+                  args.rtt / 1e3, args.bandwidth)
@@ -0,0 +1,162 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import json
+import socket
+import time
+from collections import deque
+
+
+class Progress:
+    """Running totals over the events of one run_notebooks.py build."""
+
+    def __init__(self, window):
+        self.window = window
+        self.total = None
+        self.started = None
+        self.running = {}
+        self.finished = 0
+        self.failed = 0
+        self.cells = 0
+        self.recent = deque()  # Timestamps of recent cell_end events
+
+    def add(self, e):
+        ts = e['ts']
+        if self.started is None:
+            self.started = ts
+        kind = e['event']
+        if kind == 'run_start':
+            self.total = e['notebooks']
+            self.started = ts
+        elif kind == 'notebook_start':
+            self.running[e['notebook']] = ts
+        elif kind == 'notebook_end':
+            self.running.pop(e['notebook'], None)
+            self.finished += 1
+            if e['status'] in ('error', 'timeout', 'killed'):
+                self.failed += 1
+        elif kind == 'cell_end':
+            self.cells += 1
+            self.recent.append(ts)
+        while self.recent and self.recent[0] < ts - self.window:
+            self.recent.popleft()
+
+    def cells_per_second(self, now):
+        if not self.recent:
+            return 0.0
+        return len(self.recent) / max(min(self.window, now - self.started), 1e-6)
+
+    def eta(self, now):
+        """Seconds left, assuming the remaining notebooks take as long on
+        average as the finished ones did."""
+        if not self.total or not self.finished:
+            return None
+        elapsed = now - self.started
+        return elapsed / self.finished * (self.total - self.finished)
+
+    def status(self, now):
+        eta = self.eta(now)
+        return ('%s/%s notebooks done, %d failed, %d running | %d cells, '
+                '%.2f cells/s | elapsed %s | ETA %s'
+                % (self.finished, self.total if self.total else '?',
+                   self.failed, len(self.running), self.cells,
+                   self.cells_per_second(now),
+                   format_seconds(now - self.started),
+                   '?' if eta is None else format_seconds(eta)))
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def follow_file(path, from_start, poll):
+    """Yield lines appended to path, like tail -f."""
+    while not os.path.exists(path):
+        time.sleep(poll)
+    with open(path) as f:
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+        buffered = ''
+        while True:
+            chunk = f.readline()
+            if not chunk:
+                yield None  # Nothing new; lets the caller refresh its status
+                time.sleep(poll)
+                continue
+            buffered += chunk
+            if buffered.endswith('\n'):
+                yield buffered
+                buffered = ''
+
+
+def follow_socket(path, poll):
+    """Yield the datagrams sent to a Unix socket bound at path."""
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(poll)
+    try:
+        while True:
+            try:
+                yield sock.recv(65536).decode()
+            except socket.timeout:
+                yield None
+    finally:
+        sock.close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Follows the events that \
+        run_notebooks.py --events writes, and shows the progress, throughput \
+        and ETA of the build.")
+    parser.add_argument('source', help="Events file, or 'unix:PATH' to listen \
+        on a Unix socket (start this before run_notebooks.py).")
+    parser.add_argument('--from-start', help='Replay the events already in \
+        the file before following it.', action='store_true')
+    parser.add_argument('--window', help='Seconds over which cells/s is \
+        averaged (default 60).', type=float, default=60)
+    parser.add_argument('--interval', help='Seconds between status lines \
+        (default 5).', type=float, default=5)
+    parser.add_argument('--keep', help='Keep following after the run ends.',
+        action='store_true')
+    args = parser.parse_args()
+
+    poll = min(args.interval, 0.5)
+    if args.source.startswith('unix:'):
+        lines = follow_socket(args.source[len('unix:'):], poll)
+    else:
+        lines = follow_file(args.source, args.from_start, poll)
+
+    progress = Progress(args.window)
+    last_status = 0.0
+    for line in lines:
+        now = time.time()
+        if line:
+            try:
+                e = json.loads(line)
+            except ValueError:
+                continue
+            progress.add(e)
+            kind = e['event']
+            clock = time.strftime('%H:%M:%S', time.localtime(e['ts']))
+            if kind in ('error', 'timeout', 'killed'):
+                print('%s %s in %s' % (clock, kind.upper(), e['notebook']))
+            elif kind == 'notebook_end':
+                print('%s finished %s (%s, %.1fs)'
+                      % (clock, e['notebook'], e['status'], e['seconds']))
+            elif kind == 'run_end':
+                print(progress.status(now))
+                print('Run finished in %s, %d failed.'
+                      % (format_seconds(e['seconds']), e['failed']))
+                if not args.keep:
+                    break
+                progress = Progress(args.window)
+        if progress.started is not None and now - last_status >= args.interval:
+            print(progress.status(now))
+            last_status = now
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+jupyter_cache = pytest.importorskip('jupyter_cache')
+nbformat = pytest.importorskip('nbformat')
+run_notebooks = pytest.importorskip('run_notebooks')
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'run_notebooks.py')
+
+
+def executed_notebook():
+    nb = nbformat.v4.new_notebook()
+    nb.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3',
+                                 'language': 'python'}
+    cell = nbformat.v4.new_code_cell('1 + 1', execution_count=1)
+    cell.outputs = [nbformat.v4.new_output(
+        'execute_result', {'text/plain': '2'}, execution_count=1)]
+    nb.cells.append(cell)
+    return nb
+
+
+def test_book_cache_round_trip(tmp_path):
+    args = argparse.Namespace(book_cache=str(tmp_path / 'jupyter_cache'))
+    nb = executed_notebook()
+    run_notebooks.store_in_book_cache(nb, str(tmp_path / 'chapter'), 'abc',
+                                      args)
+
+    cache = jupyter_cache.get_cache(args.book_cache)
+    record = cache.match_cache_notebook(executed_notebook())
+    assert record.data == {'notebook_hash': 'abc'}
+    bundle = cache.get_cache_bundle(record.pk)
+    assert bundle.nb.cells[0].outputs[0]['data']['text/plain'] == '2'
+
+    assert run_notebooks.book_cache_record(nb, 'abc', args).pk == record.pk
+    assert run_notebooks.book_cache_record(nb, 'other', args) is None
+
+
+def run_script(cwd, *args):
+    return subprocess.run([sys.executable, SCRIPT, '--no-book-cache',
+                           '--poll', '0.2'] + list(args),
+                          cwd=cwd, capture_output=True, text=True, check=True,
+                          timeout=300)
+
+
+def test_resume_after_queue_run(tmp_path):
+    pytest.importorskip('ipykernel')
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('1 + 1')])
+    nbformat.write(nb, str(tmp_path / 'chapter.ipynb'))
+
+    run_script(tmp_path, 'chapter.ipynb', '--queue', 'queue',
+               '--local-workers', '1')
+    with open(tmp_path / 'run_manifest.json') as f:
+        manifest = json.load(f)
+    assert list(manifest) == ['chapter']
+    assert manifest['chapter']['state'] == 'done'
+
+    out = tmp_path / 'chapter_out.ipynb'
+    written = out.stat().st_mtime_ns
+    resumed = run_script(tmp_path, 'chapter.ipynb', '--queue', 'queue',
+                         '--local-workers', '1', '--resume')
+    assert 'Resuming: 1 notebooks are already done.' in resumed.stdout
+    assert 'Finished' not in resumed.stdout
+    assert out.stat().st_mtime_ns == written
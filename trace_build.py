@@ -0,0 +1,149 @@
+# ! python
+# coding: utf-8
+
+import os
+import argparse
+import glob
+import json
+import subprocess
+import sys
+import time
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Chrome trace process ids for the steps run from here; notebook workers
+# and Sphinx processes use their real pids
+DRIVER_PID = 0
+
+
+def now_us():
+    return time.time() * 1e6
+
+
+def step(trace, name, command):
+    """Run command as one step of the build, adding a span for it."""
+    print('*****')
+    print(name + ':', ' '.join(command))
+    start = now_us()
+    returncode = subprocess.call(command)
+    trace.append({'name': name, 'cat': 'step', 'ph': 'X', 'ts': start,
+                  'dur': now_us() - start, 'pid': DRIVER_PID, 'tid': 0,
+                  'args': {'command': ' '.join(command),
+                           'returncode': returncode}})
+    return returncode
+
+
+def notebook_spans(events_file):
+    """Turn run_notebooks.py events into spans: one per notebook run and one
+    per executed cell, on a track for each worker process."""
+    trace = []
+    workers = set()
+    with open(events_file) as f:
+        for line in f:
+            e = json.loads(line)
+            if e['event'] not in ('notebook_end', 'cell_end'):
+                continue
+            if e['event'] == 'notebook_end' and e['status'] == 'cached':
+                continue
+            end = e['ts'] * 1e6
+            dur = e['seconds'] * 1e6
+            if e['event'] == 'notebook_end':
+                name = os.path.basename(e['notebook'])
+                args = {'status': e['status']}
+            else:
+                name = 'cell %d' % e['cell']
+                args = {'notebook': e['notebook'], 'status': e['status']}
+            trace.append({'name': name, 'cat': 'execute', 'ph': 'X',
+                          'ts': end - dur, 'dur': dur, 'pid': e['pid'],
+                          'tid': 0, 'args': args})
+            workers.add((e['pid'], e['host']))
+    for pid, host in workers:
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                      'args': {'name': 'notebook worker %s:%d' % (host, pid)}})
+    return trace
+
+
+def traced_config(config, trace_file):
+    """Write a copy of the book config next to it that tells the
+    build_trace extension, which the book always loads, where to write its
+    trace, and return its path.  Nothing else changes, so Sphinx reads the
+    same documents as in an untraced build."""
+    with open(config) as f:
+        cfg = yaml.safe_load(f) or {}
+    sphinx = cfg.get('sphinx') or {}
+    sphinx['config'] = dict(sphinx.get('config') or {},
+                            build_trace_file=os.path.abspath(trace_file))
+    cfg['sphinx'] = sphinx
+    path = os.path.join(os.path.dirname(os.path.abspath(config)),
+                        '_config_trace.yml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(cfg, f, sort_keys=False)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the book like \
+        build.sh, but without publishing it, and writes a Chrome/Perfetto \
+        trace of the whole build: notebook execution per cell, Sphinx reading \
+        and writing per document, bibliography processing and copying of \
+        images and static files.")
+    parser.add_argument('source', nargs='?', default=os.path.join(HERE, 'Chapters'),
+        help='Book source directory (default Chapters).')
+    parser.add_argument('--path-output', default=os.path.join(HERE, 'Book'),
+        help='Where jupyter-book writes _build (default Book).')
+    parser.add_argument('--config', default=os.path.join(HERE, 'yaml', '_config.yml'),
+        help='Book config (default yaml/_config.yml).')
+    parser.add_argument('--toc', default=os.path.join(HERE, 'yaml', '_toc.yml'),
+        help='Book table of contents (default yaml/_toc.yml).')
+    parser.add_argument('-o', '--output', default='build_trace.json',
+        help='Trace file to write (default build_trace.json). Open it in \
+        ui.perfetto.dev or chrome://tracing.')
+    parser.add_argument('-n', '--run-notebooks', help='Execute the notebooks \
+        with run_notebooks.py first, passing it these extra arguments, e.g. \
+        "--jobs 4". Its per-cell events are included in the trace.',
+        default=None, metavar='ARGS')
+    args = parser.parse_args()
+
+    trace = [{'name': 'process_name', 'ph': 'M', 'pid': DRIVER_PID,
+              'args': {'name': 'build'}}]
+    stem = os.path.splitext(args.output)[0]
+    events_file = stem + '_events.jsonl'
+    sphinx_trace = stem + '_sphinx.json'
+    for path in (events_file, sphinx_trace):
+        if os.path.exists(path):
+            os.remove(path)
+
+    start = now_us()
+    if args.run_notebooks is not None:
+        notebooks = sorted(glob.glob(os.path.join(args.source, '*.ipynb')))
+        step(trace, 'run_notebooks.py',
+             [sys.executable, os.path.join(HERE, 'run_notebooks.py'),
+              '--events', events_file, '--run-path', args.source,
+              '--book-cache', os.path.join(args.path_output, '_build',
+                                           '.jupyter_cache')]
+             + args.run_notebooks.split() + notebooks)
+
+    config = traced_config(args.config, sphinx_trace)
+    try:
+        returncode = step(trace, 'jupyter-book build',
+                          ['jupyter-book', 'build', args.source,
+                           '--path-output', args.path_output,
+                           '--config', config, '--toc', args.toc])
+    finally:
+        os.remove(config)
+    trace.append({'name': 'build', 'cat': 'step', 'ph': 'X', 'ts': start,
+                  'dur': now_us() - start, 'pid': DRIVER_PID, 'tid': 0,
+                  'args': {}})
+
+    if os.path.exists(events_file):
+        trace.extend(notebook_spans(events_file))
+    if os.path.exists(sphinx_trace):
+        with open(sphinx_trace) as f:
+            trace.extend(json.load(f)['traceEvents'])
+    with open(args.output, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+    print('*****')
+    print('Trace written to', args.output)
+    sys.exit(returncode)